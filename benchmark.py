@@ -0,0 +1,453 @@
+"""
+	Measures blacksmith's own overhead on a synthetic asset tree.
+
+	A source tree is generated with the requested number of files,
+	spread over one folder per asset mask, along with a matching asset
+	config. The tools used are built-ins or no-ops, so the timings
+	reflect the orchestrator rather than the tools it runs.
+
+	Results are written as JSON so they can be tracked over time:
+
+		python benchmark.py --files 100000 --masks 8 -j 8 -o results.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import BaseHTTPServer
+
+from blacksmith import iterate_assets
+from models import (
+	AssetFolderMask,
+	AttributeStore,
+	Cache,
+	Tool
+)
+from util import (
+	make_dirs,
+	scan_asset_folders
+)
+
+EXTENSIONS = ["png", "tga", "wav", "json", "vert", "frag"]
+
+BENCHMARK_TOOLS = {
+	"noop":
+	{
+		"linux": [ "true" ],
+		"macosx": [ "true" ],
+		"windows": [ "cmd /c rem" ]
+	},
+	"shell_copy":
+	{
+		"linux": [ "cp %(src_file_path)s %(dst_file_path)s" ],
+		"macosx": [ "cp %(src_file_path)s %(dst_file_path)s" ],
+		"windows": [ "copy /Y %(src_file_path)s %(dst_file_path)s" ],
+		"output": "%(dst_file_path)s"
+	}
+}
+
+def generate_tree(root, num_files, num_masks, depth, file_size):
+	"""
+		Create num_files files under root/source, spread evenly over one
+		folder per mask. Masks only match the top level of their folder,
+		so depth adds that many levels of nested folders (with files that
+		no mask matches) to each one.
+
+		Returns the asset config dict for the tree.
+	"""
+	source_root = os.path.join(root, "source")
+	payload = "x" * file_size
+	assets = {}
+
+	for mask in range(num_masks):
+		extension = EXTENSIONS[mask % len(EXTENSIONS)]
+		folder = "folder%i" % mask
+		abs_folder = os.path.join(source_root, folder)
+		make_dirs(abs_folder)
+
+		nested_folder = abs_folder
+		for level in range(depth):
+			nested_folder = os.path.join(nested_folder, "nested%i" % level)
+			make_dirs(nested_folder)
+			with open(os.path.join(nested_folder, "ignored.%s" % extension), "wb") as file:
+				file.write(payload)
+
+		count = num_files // num_masks
+		if mask < num_files % num_masks:
+			count += 1
+		for index in range(count):
+			path = os.path.join(abs_folder, "file%i.%s" % (index, extension))
+			with open(path, "wb") as file:
+				file.write(payload)
+
+		assets["%s/*.%s" % (folder, extension)] = {"tool": "noop"}
+
+	return {
+		"paths":
+		{
+			"source_root": source_root,
+			"destination_root": os.path.join(root, "destination")
+		},
+		"tools": BENCHMARK_TOOLS,
+		"assets": assets
+	}
+
+def load_benchmark(config, tool_name):
+	settings = AttributeStore()
+	settings.paths = AttributeStore(config["paths"])
+
+	tools = {}
+	Tool.load_tools(
+		tools,
+		os.path.join(os.path.dirname(os.path.abspath(__file__)), "tools.conf"),
+		dict(config["tools"])
+	)
+
+	asset_folders = []
+	for asset_glob in sorted(config["assets"]):
+		asset_folder = AssetFolderMask(glob=asset_glob, tool=tool_name)
+		asset_folder.make_folders_absolute(
+			settings.paths.source_root,
+			settings.paths.destination_root
+		)
+		asset_folders.append(asset_folder)
+	return settings, tools, asset_folders
+
+def timed(function, *args):
+	start = time.time()
+	result = function(*args)
+	return time.time() - start, result
+
+def rate(count, seconds):
+	return {
+		"seconds": seconds,
+		"files_per_second": count / seconds if seconds > 0 else None
+	}
+
+def benchmark_scan(asset_folders, num_files):
+	seconds, scanned = timed(scan_asset_folders, asset_folders)
+	found = sum(len(files) for files, folders in scanned.itervalues())
+	result = rate(found, seconds)
+	result["files"] = found
+	return result
+
+def benchmark_cache(root, asset_folders, num_files):
+	config_path = os.path.join(root, "cache_benchmark.conf")
+	scanned = scan_asset_folders(asset_folders)
+	files = []
+	for asset in asset_folders:
+		files.extend(scanned.get(asset, ([], []))[0])
+
+	cache = Cache(config_path, remove=True)
+	load_seconds, _ = timed(cache.load)
+
+	def add_all():
+		for path, stat, mask in files:
+			cache.update(path, "recipe", stat)
+	add_seconds, _ = timed(add_all)
+	save_seconds, _ = timed(cache.save)
+
+	cache = Cache(config_path)
+	reload_seconds, _ = timed(cache.load)
+
+	def check_all():
+		for path, stat, mask in files:
+			cache.update(path, "recipe", stat)
+	check_seconds, _ = timed(check_all)
+	cache.save()
+
+	return {
+		"entries": len(files),
+		"cache_bytes": os.path.getsize(cache.abs_cache_path),
+		"create_seconds": load_seconds,
+		"add": rate(len(files), add_seconds),
+		"save_seconds": save_seconds,
+		"load_seconds": reload_seconds,
+		"up_to_date_check": rate(len(files), check_seconds)
+	}
+
+def deep_size(value, seen=None):
+	"""
+		Approximate the memory held by value and everything it refers to.
+	"""
+	if seen is None:
+		seen = set()
+	if id(value) in seen:
+		return 0
+	seen.add(id(value))
+
+	size = sys.getsizeof(value)
+	if isinstance(value, dict):
+		for key, item in value.iteritems():
+			size += deep_size(key, seen) + deep_size(item, seen)
+	elif isinstance(value, (list, tuple)):
+		for item in value:
+			size += deep_size(item, seen)
+	return size
+
+def benchmark_cache_memory(root, config, asset_folders):
+	"""
+		Compare the entries held in memory by the cache against the
+		dict of absolute path -> modified time older versions loaded
+		from JSON.
+	"""
+	scanned = scan_asset_folders(asset_folders)
+	files = []
+	for asset in asset_folders:
+		files.extend(scanned.get(asset, ([], []))[0])
+
+	legacy = dict((path, stat.st_mtime) for path, stat, mask in files)
+	legacy_path = os.path.join(root, "memory_benchmark.legacy")
+	with open(legacy_path, "wb") as file:
+		json.dump(legacy, file)
+
+	def load_legacy():
+		with open(legacy_path, "rb") as file:
+			return json.load(file)
+	legacy_load_seconds, legacy = timed(load_legacy)
+
+	def check_legacy():
+		for path, stat, mask in files:
+			stat.st_mtime <= legacy[path]
+	legacy_check_seconds, _ = timed(check_legacy)
+
+	config_path = os.path.join(root, "memory_benchmark.conf")
+	source_root = config["paths"]["source_root"]
+	cache = Cache(config_path, remove=True, source_root=source_root)
+	cache.load()
+	for path, stat, mask in files:
+		cache.update(path, "recipe", stat)
+	cache.save()
+
+	cache = Cache(config_path, source_root=source_root)
+	load_seconds, _ = timed(cache.load)
+
+	def check_all():
+		for path, stat, mask in files:
+			cache.get_entry(path)
+	check_seconds, _ = timed(check_all)
+
+	return {
+		"entries": len(files),
+		"legacy_dict": {
+			"bytes": deep_size(legacy),
+			"load_seconds": legacy_load_seconds,
+			"lookup": rate(len(files), legacy_check_seconds)
+		},
+		"cache": {
+			"bytes": deep_size(cache.directories),
+			"held_entries": cache.prefetched,
+			"prefetch_limit": Cache.PREFETCH_LIMIT,
+			"load_seconds": load_seconds,
+			"lookup": rate(len(files), check_seconds)
+		}
+	}
+
+def benchmark_build(root, config, tool_name, jobs, num_files, name):
+	"""
+		Time a clean build with tool_name, then an up-to-date rebuild.
+	"""
+	settings, tools, asset_folders = load_benchmark(config, tool_name)
+	destination_root = settings.paths.destination_root
+	if os.path.isdir(destination_root):
+		shutil.rmtree(destination_root)
+
+	cache = Cache(os.path.join(root, "%s.conf" % name), remove=True)
+	cache.load()
+	clean_seconds, _ = timed(
+		iterate_assets, cache, settings, asset_folders, tools, get_benchmark_platform(), jobs
+	)
+	cache.save()
+
+	settings, tools, asset_folders = load_benchmark(config, tool_name)
+	noop_seconds, _ = timed(
+		iterate_assets, cache, settings, asset_folders, tools, get_benchmark_platform(), jobs
+	)
+	cache.save()
+
+	return {
+		"tool": tool_name,
+		"jobs": jobs,
+		"clean_build": rate(num_files, clean_seconds),
+		"up_to_date_rebuild": rate(num_files, noop_seconds)
+	}
+
+def get_benchmark_platform():
+	if sys.platform.startswith("linux"):
+		return "linux"
+	elif sys.platform == "darwin":
+		return "macosx"
+	return "windows"
+
+class ReloadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def do_PUT(self):
+		length = int(self.headers.getheader("content-length", 0))
+		self.rfile.read(length)
+		self.send_response(204)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+	def log_message(self, *args):
+		pass
+
+def benchmark_monitor(root, config, jobs, samples, watcher):
+	"""
+		Run blacksmith in monitor mode and measure the time from
+		writing a source file until its output appears.
+	"""
+	server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), ReloadHandler)
+	server_thread = threading.Thread(target=server.serve_forever)
+	server_thread.daemon = True
+	server_thread.start()
+
+	config = dict(config)
+	first_mask = sorted(config["assets"])[0]
+	config["assets"] = {first_mask: {"tool": "copy"}}
+	config["monitor"] = {
+		"url": "http://127.0.0.1:%i/reload" % server.server_port,
+		"settle": 0.01,
+		"poll_interval": 0.05
+	}
+	if watcher:
+		config["monitor"]["watcher"] = watcher
+
+	config_path = os.path.join(root, "monitor.conf")
+	with open(config_path, "wb") as file:
+		json.dump(config, file)
+
+	blacksmith_path = os.path.join(
+		os.path.dirname(os.path.abspath(__file__)), "blacksmith.py"
+	)
+	with open(os.devnull, "wb") as devnull:
+		process = subprocess.Popen(
+			[sys.executable, blacksmith_path, "-c", config_path, "-y", "-j", str(jobs)],
+			stdout=devnull,
+			stderr=devnull
+		)
+
+	source_folder = os.path.join(config["paths"]["source_root"], first_mask.split("/")[0])
+	destination_folder = os.path.join(config["paths"]["destination_root"], first_mask.split("/")[0])
+	extension = first_mask.split(".")[-1]
+	latencies = []
+	try:
+		# give the watcher time to take its initial snapshot
+		time.sleep(1.0)
+		for index in range(samples):
+			name = "monitor%i.%s" % (index, extension)
+			output_path = os.path.join(destination_folder, name)
+			start = time.time()
+			with open(os.path.join(source_folder, name), "wb") as file:
+				file.write("sample")
+
+			while not os.path.exists(output_path):
+				if time.time() - start > 10.0:
+					break
+				time.sleep(0.001)
+			else:
+				latencies.append(time.time() - start)
+	finally:
+		process.terminate()
+		process.wait()
+		server.shutdown()
+
+	latencies.sort()
+	result = {"samples": len(latencies), "watcher": watcher or "default"}
+	if latencies:
+		result["median_seconds"] = latencies[len(latencies) // 2]
+		result["p90_seconds"] = latencies[int(len(latencies) * 0.9)]
+		result["max_seconds"] = latencies[-1]
+	return result
+
+def main():
+	p = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+	p.add_argument("--files", type=int, default=1000)
+	p.add_argument("--masks", type=int, default=4)
+	p.add_argument("--depth", type=int, default=0)
+	p.add_argument("--file-size", dest="file_size", type=int, default=64)
+	p.add_argument("-j", "--jobs", dest="jobs", type=int, default=4)
+	p.add_argument("--monitor-samples", dest="monitor_samples", type=int, default=20)
+	p.add_argument(
+		"--watcher",
+		dest="watcher",
+		help="Monitor watcher to benchmark (\"poll\" to force polling)"
+	)
+	p.add_argument(
+		"--skip",
+		dest="skip",
+		default="",
+		help="Comma separated benchmarks to skip (scan,cache,memory,build,copy,monitor)"
+	)
+	p.add_argument("--root", dest="root", help="Where to generate the tree")
+	p.add_argument("--keep", dest="keep", action="store_true")
+	p.add_argument("-o", "--output", dest="output_path")
+	args = p.parse_args()
+	skip = set(args.skip.split(","))
+
+	root = args.root or tempfile.mkdtemp(prefix="blacksmith_benchmark_")
+	make_dirs(root)
+
+	# per-file logging would dominate the timings
+	logging.basicConfig(level=logging.WARNING)
+
+	try:
+		generate_seconds, config = timed(
+			generate_tree, root, args.files, args.masks, args.depth, args.file_size
+		)
+		settings, tools, asset_folders = load_benchmark(config, "noop")
+
+		results = {
+			"parameters": {
+				"files": args.files,
+				"masks": args.masks,
+				"depth": args.depth,
+				"file_size": args.file_size,
+				"jobs": args.jobs,
+				"python": sys.version.split()[0],
+				"platform": sys.platform
+			},
+			"generate_seconds": generate_seconds
+		}
+
+		if "scan" not in skip:
+			results["scan"] = benchmark_scan(asset_folders, args.files)
+		if "cache" not in skip:
+			results["cache"] = benchmark_cache(root, asset_folders, args.files)
+		if "memory" not in skip:
+			results["cache_memory"] = benchmark_cache_memory(
+				root, config, asset_folders
+			)
+		if "build" not in skip:
+			results["dispatch"] = benchmark_build(
+				root, config, "noop", args.jobs, args.files, "dispatch"
+			)
+		if "copy" not in skip:
+			results["copy"] = [
+				benchmark_build(root, config, tool_name, args.jobs, args.files, tool_name)
+				for tool_name in ("copy", "shell_copy")
+			]
+		if "monitor" not in skip:
+			results["monitor"] = benchmark_monitor(
+				root, config, args.jobs, args.monitor_samples, args.watcher
+			)
+	finally:
+		if not args.keep and not args.root:
+			shutil.rmtree(root, ignore_errors=True)
+
+	output = json.dumps(results, indent=4, sort_keys=True)
+	if args.output_path:
+		with open(args.output_path, "wb") as file:
+			file.write(output)
+	else:
+		print output
+
+if __name__ == "__main__":
+	main()
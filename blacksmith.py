@@ -7,36 +7,62 @@ import re
 import time
 import copy
 import socket
+import threading
 import fnmatch
+import multiprocessing
 import shutil
+import sys
 
 from models import (
 	AssetFolderMask,
+	AssetMaskIndex,
 	AttributeStore,
+	BufferedLog,
+	BuildTrace,
 	Cache,
 	KeyValueCache,
+	OutputStore,
+	PollingWatcher,
+	ReloadNotifier,
 	WorkingDirectory,
 	Tool,
-	UnknownToolException
+	ToolFailedException,
+	UnknownToolException,
+	WorkerPool,
+	WorkQueue
 )
 
 from util import(
+	copy_file,
 	execute_commands,
 	generate_params_for_file,
+	get_physical_memory,
 	get_platform,
+	hash_commands,
+	hash_file,
+	in_shard,
+	list_outputs,
 	make_dirs,
 	normalize_paths,
+	parse_shard,
+	remove_file,
+	resolve_batch_commands,
+	resolve_commands,
 	run_as_shell,
+	scan_asset_folders,
 	setup_environment,
+	split_outputs,
 	strip_trailing_slash,
 	type_is_string,
-	copy_tree
+	validate_tool_templates
 )
 
 CONFIG_TYPE_MAP = {
 	"paths": [dict],
 	"tools": [dict],
 	"assets": [dict],
+	"store": [dict],
+	"budget": [dict],
 	"host_platform": [str, unicode],
 	"target_platform": [str, unicode]
 }
@@ -91,12 +117,12 @@ def load_config(path, config_cache):
 		path)
 	)
 
-	WorkingDirectory.push(os.path.dirname(path))
-
 	# check the cache first
 	if config_cache.contains(abs_path):
 		return config_cache.get(abs_path)
 
+	WorkingDirectory.push(os.path.dirname(path))
+
 	# need to load it from disk
 	if os.path.exists(abs_path):
 		with open(abs_path, "rb") as file:
@@ -119,33 +145,317 @@ def load_config(path, config_cache):
 
 	return config
 
+RESOLVED_CONFIG_EXTENSION = "resolved"
+RESOLVED_CONFIG_VERSION = 1
+
+def load_resolved_config(path, write=True):
+	"""
+		Load the config at path with all of its includes applied.
+
+		The resolved config is kept next to the config file along with
+		a manifest of every file it was built from. If none of those
+		files changed, the includes are not read or merged again.
+		Without write, a stale resolved config is not updated.
+	"""
+	abs_path = os.path.abspath(path)
+	resolved_path = "%s.%s" % (
+		os.path.splitext(abs_path)[0],
+		RESOLVED_CONFIG_EXTENSION
+	)
+
+	if os.path.exists(resolved_path):
+		try:
+			with open(resolved_path, "rb") as file:
+				resolved = json.load(file)
+		except ValueError:
+			resolved = None
+
+		if resolved and resolved.get("version") == RESOLVED_CONFIG_VERSION:
+			manifest, changed = check_config_manifest(resolved["manifest"])
+			if manifest is not None:
+				if changed and write:
+					resolved["manifest"] = manifest
+					write_resolved_config(resolved_path, resolved)
+				return resolved["config"]
+
+	config_cache = KeyValueCache()
+	config = load_config(path, config_cache)
+
+	# the loaded files are the keys of the config cache
+	manifest = []
+	for included_path in sorted(config_cache.cache.keys()):
+		stat = os.stat(included_path)
+		manifest.append([
+			included_path,
+			stat.st_size,
+			stat.st_mtime,
+			hash_file(included_path)
+		])
+
+	if write:
+		write_resolved_config(resolved_path, {
+			"version": RESOLVED_CONFIG_VERSION,
+			"manifest": manifest,
+			"config": config
+		})
+	return config
+
+def check_config_manifest(manifest):
+	"""
+		Return (manifest, changed) if every file in the manifest still
+		has the same contents, or (None, True) if any of them changed.
+		Files are only hashed when their size or mtime differ.
+	"""
+	changed = False
+	updated = []
+	for included_path, size, mtime, digest in manifest:
+		try:
+			stat = os.stat(included_path)
+		except OSError:
+			return None, True
+
+		if stat.st_size != size or stat.st_mtime != mtime:
+			if hash_file(included_path) != digest:
+				return None, True
+			changed = True
+		updated.append([included_path, stat.st_size, stat.st_mtime, digest])
+	return updated, changed
+
+def write_resolved_config(resolved_path, resolved):
+	# write to a temporary file first so a partial
+	# write is never read back.
+	temp_path = resolved_path + ".tmp"
+	with open(temp_path, "wb") as file:
+		json.dump(resolved, file, separators=(",", ":"))
+	if get_platform() == "windows" and os.path.exists(resolved_path):
+		os.unlink(resolved_path)
+	os.rename(temp_path, resolved_path)
+
+def record_outputs(cache, settings, abs_src_path, outputs):
+	"""
+		Record the outputs built from abs_src_path, and remove those it
+		was previously built into but no longer is.
+	"""
+	previous_outputs = cache.get_outputs(abs_src_path)
+	cache.set_outputs(abs_src_path, outputs)
+	remove_outputs(
+		cache,
+		settings,
+		[output for output in previous_outputs if output not in outputs]
+	)
+
+def remove_source(cache, settings, abs_src_path, tool=None):
+	"""
+		Remove the outputs of a source file that was deleted, or is no
+		longer matched by an asset entry, and forget it in the cache.
+		tool is the tool of the asset entry matching abs_src_path, if any.
+
+		Returns the outputs removed, or None if the file was not in
+		the cache.
+	"""
+	outputs = cache.remove_entry(abs_src_path)
+	if outputs is None:
+		return None
+
+	# moved away by its tool rather than deleted; caches written
+	# before consumes_source still list its outputs.
+	if tool is not None and consumes_source(tool):
+		return []
+
+	logging.info(
+		"%c -> %s" % (
+			Cache.ALTER_TABLE[Cache.CACHE_REMOVED],
+			Cache.describe(abs_src_path)
+		)
+	)
+	remove_outputs(cache, settings, outputs)
+	return outputs
+
+def matching_tool(index, tools, abs_src_path):
+	"""
+		Returns the tool of the first asset entry (see AssetMaskIndex)
+		matching abs_src_path, or None.
+	"""
+	asset, relative_path = index.find(Cache.file_path(abs_src_path))
+	if asset is None:
+		return None
+	return tools.get(asset.tool)
+
+def consumes_source(tool):
+	"""
+		Returns True if tool moves its source file away. Its outputs are
+		then the only copy of the file, so they are not recorded and
+		never removed as orphans.
+	"""
+	return tool.builtin == "move"
+
+def remove_outputs(cache, settings, outputs):
+	# outputs may be shared by several sources
+	for output in outputs:
+		if not cache.is_output_referenced(output):
+			remove_file(output, settings.paths.destination_root)
+
+def sync_file(cache, settings, src_file_path, dst_file_path, stat=None):
+	"""
+		Copy a file inside a matched folder, unless the cache shows it
+		is unchanged and it is already in place.
+		Returns True if the file was copied.
+	"""
+	recipe = "sync:%s" % cache.output_key(dst_file_path)
+	if not cache.update(src_file_path, recipe, stat, dirty=True) and (
+		os.path.lexists(dst_file_path)
+	):
+		return False
+
+	copy_file(src_file_path, dst_file_path)
+	record_outputs(cache, settings, src_file_path, [dst_file_path])
+	cache.set_dirty(src_file_path, False)
+	return True
+
+def sync_tree(cache, settings, source, destination):
+	"""
+		Bring the folder destination up to date with the folder source,
+		such as an .app or .dSYM bundle matched by an asset mask.
+
+		Only files that changed are copied, and files removed from the
+		source are removed from the destination. Each file has its own
+		cache entry. Symbolic links are recreated rather than followed.
+
+		Returns (source_paths, copied), where source_paths is a set of
+		the files found in source.
+	"""
+	source_paths = set()
+	copied = 0
+
+	for root, folders, names in os.walk(source):
+		target_root = os.path.normpath(
+			os.path.join(destination, os.path.relpath(root, source))
+		)
+		make_dirs(target_root)
+
+		for name in folders + names:
+			src_file_path = os.path.join(root, name)
+			dst_file_path = os.path.join(target_root, name)
+			if os.path.islink(src_file_path):
+				source_paths.add(src_file_path)
+				link = os.readlink(src_file_path)
+				if not os.path.islink(dst_file_path) or (
+					os.readlink(dst_file_path) != link
+				):
+					if os.path.isdir(dst_file_path) and not os.path.islink(dst_file_path):
+						shutil.rmtree(dst_file_path)
+					elif os.path.lexists(dst_file_path):
+						os.unlink(dst_file_path)
+					os.symlink(link, dst_file_path)
+					copied += 1
+			elif name in names:
+				source_paths.add(src_file_path)
+				if sync_file(cache, settings, src_file_path, dst_file_path):
+					copied += 1
+
+	# files removed from the source
+	for src_file_path in cache.paths(source):
+		if src_file_path not in source_paths:
+			remove_source(cache, settings, src_file_path)
+
+	# anything else in the destination, such as files from before
+	# the folder was synced incrementally
+	for root, folders, names in os.walk(destination, topdown=False):
+		src_root = os.path.normpath(
+			os.path.join(source, os.path.relpath(root, destination))
+		)
+		for name in names + folders:
+			dst_file_path = os.path.join(root, name)
+			src_file_path = os.path.join(src_root, name)
+			if src_file_path in source_paths:
+				continue
+			if os.path.isdir(dst_file_path) and not os.path.islink(dst_file_path):
+				if os.path.isdir(src_file_path) and not os.path.islink(src_file_path):
+					continue
+				shutil.rmtree(dst_file_path)
+			else:
+				os.unlink(dst_file_path)
+
+	return source_paths, copied
+
+def compare_tree(cache, source, destination):
+	"""
+		Find what sync_tree would change, without copying anything
+		or writing to the cache.
+
+		Returns (source_paths, changes), where source_paths is a set of
+		the files found in source and changes is a list of (status,
+		src_file_path) for each file that would be copied or removed.
+	"""
+	source_paths = set()
+	changes = []
+
+	for root, folders, names in os.walk(source):
+		target_root = os.path.normpath(
+			os.path.join(destination, os.path.relpath(root, source))
+		)
+
+		for name in folders + names:
+			src_file_path = os.path.join(root, name)
+			dst_file_path = os.path.join(target_root, name)
+			if os.path.islink(src_file_path):
+				source_paths.add(src_file_path)
+				if not os.path.islink(dst_file_path):
+					changes.append((Cache.CACHE_ADDED, src_file_path))
+				elif os.readlink(dst_file_path) != os.readlink(src_file_path):
+					changes.append((Cache.CACHE_UPDATED, src_file_path))
+			elif name in names:
+				source_paths.add(src_file_path)
+				recipe = "sync:%s" % cache.output_key(dst_file_path)
+				status, entry = cache.compare(src_file_path, recipe)
+				if status != Cache.CACHE_IS_NEWER:
+					changes.append((status, src_file_path))
+				elif not os.path.lexists(dst_file_path):
+					changes.append((Cache.CACHE_UPDATED, src_file_path))
+
+	# files removed from the source
+	for src_file_path in cache.paths(source):
+		if src_file_path not in source_paths:
+			changes.append((Cache.CACHE_REMOVED, src_file_path))
+
+	return source_paths, changes
+
 def monitor_assets(
 		cache, 
 		settings, 
 		asset_folders,
 		tools, 
 		platform,
-		server_url
+		server_url,
+		jobs = 1,
+		settle = 0.05,
+		notify_window = 0.05,
+		watcher = None,
+		poll_interval = 1.0,
+		poll_rate = None,
+		budget = None
 	):
 
+	# watchdog is optional; without it (or when asked to) the
+	# asset folders are polled instead.
 	try:
-		import watchdog
-		from watchdog.events import FileSystemEventHandler, LoggingEventHandler
+		from watchdog.events import FileSystemEventHandler
 		from watchdog.observers import Observer
-	except:
-		logging.error("Unable to import watchdog. It is required for monitoring!")
-		raise
-
-
+	except ImportError:
+		FileSystemEventHandler = object
+		Observer = None
 
-	# experimental for reload requests (should use requests lib)
-	import httplib
+	if watcher != "poll" and Observer is None:
+		logging.warn("Unable to import watchdog; polling the asset folders instead.")
 
-
-	class Apprentice(watchdog.events.FileSystemEventHandler):
+	class Apprentice(FileSystemEventHandler):
 		"""
 			The apprentice will help us out by monitoring the paths we
 			are interested in.
+
+			Events arrive on watchdog's thread and are only queued there.
+			process_events runs on the main thread, which owns the cache,
+			and hands tool execution to the worker pool.
 		"""
 
 		def __init__(
@@ -155,20 +465,29 @@ def monitor_assets(
 				asset_folders,
 				tools,
 				platform,
-				server_url = None
+				server_url = None,
+				jobs = 1
 			):
 			self.cache = cache
 			self.settings = settings
 			self.asset_folders = asset_folders
+			self.index = AssetMaskIndex(asset_folders)
 			self.tools = tools
 			self.platform = platform
 			
-			self.server_url = None
-			if server_url and server_url.startswith("http://"):
-				self.server_url = server_url[7:]
+			self.notifier = None
+			if server_url:
+				self.notifier = ReloadNotifier(server_url, notify_window)
+
+			self.queue = WorkQueue()
+			self.pool = WorkerPool(jobs, budget)
 
-			self.send_reload_requests = self.server_url != None
-			self.queue = []
+			# paths with jobs in flight (path -> number of jobs), and
+			# those modified again while their jobs were running.
+			self.lock = threading.Lock()
+			self.active = {}
+			self.deferred = set()
+			self.job_paths = {}
 
 		def handle_event(self, event):
 			source_path = event.src_path
@@ -180,97 +499,225 @@ def monitor_assets(
 				destination_path = event.dest_path
 
 			#logging.info("%s | %s" % (source_path, destination_path))
-			self.queue.append(target_path)
+			self.queue.put(target_path)
 
 		def on_created(self, event):
 			self.handle_event(event)
 
 		def on_deleted(self, event):
-			# For now, we don't handle deletions
-			pass
-			#self.handle_event(event)
+			self.queue.put(event.src_path)
 
 		def on_modified(self, event):
 			self.handle_event(event)
 
 		def on_moved(self, event):
+			# the old path is handled as a deletion
+			self.queue.put(event.src_path)
 			self.handle_event(event)
 
-		def process_events(self):
-			queued_items = self.queue[:]
-			self.queue = []
-
+		def wait_for_events(self, timeout=1.0):
+			"""
+				Block until events arrive (or timeout) and process them.
+			"""
+			queued_items = self.queue.get_all(timeout, settle)
+
+			self.collect()
+			self.process_events(queued_items)
+
+		def collect(self):
+			# re-raise any errors from finished jobs
+			for index, outputs in self.pool.completed():
+				cache_path = self.job_paths.pop(index)
+				if outputs is None:
+					# left dirty; retried when it changes or on the next run
+					continue
+				record_outputs(self.cache, self.settings, cache_path, outputs)
+				self.cache.set_dirty(cache_path, False)
+
+		def process_events(self, queued_items):
 			for target_path in queued_items:
-				for asset in asset_folders:
-					match = re.search(asset.get_abs_regex(), target_path)
-					if match:
-
-						# determine if this is a directory path
-						# a file in a subdirectory
-						source_to_target_path = os.path.relpath(target_path, self.settings.paths.source_root)
-						asset_target_relative = os.path.relpath(source_to_target_path, asset.src_folder)
-						subdir = os.path.sep in asset_target_relative
-						is_directory = os.path.isdir(target_path) or subdir
-
-						if is_directory:
-							# We don't want to perform tree copies for modified files
-							# inside of a subfolder; only do that on the root subfolder.
-							if not subdir:
-								source_path = target_path
-								destination_path = os.path.join(settings.paths.destination_root, asset.dst_folder, asset_target_relative)
-								copy_tree(source_path, destination_path)
-							break
-						
-						try:
-							# try to update the cache
-							if not self.cache.update(target_path):
-								break
-
-							if self.tools.has_key(asset.tool):
-								tool = tools[asset.tool]
-							else:
-								raise UnknownToolException(
-									"Unknown tool \"%s\"" % asset.tool
-								)
-
-							outputs = execute_commands(
-								self.tools, 
-								tool, 
-								self.settings.paths,
-								asset,
-								target_path,
-								self.platform
+				with self.lock:
+					if target_path in self.active:
+						# picked up again once the running job finishes
+						self.deferred.add(target_path)
+						continue
+
+				if not os.path.lexists(target_path):
+					# deleted, or renamed away; a deleted folder
+					# removes each file the cache has inside it.
+					removed = [
+						remove_source(
+							self.cache,
+							self.settings,
+							cache_path,
+							matching_tool(self.index, self.tools, cache_path)
+						)
+						for cache_path in
+						[target_path] + self.cache.mask_paths(target_path)
+					]
+					if all(outputs is None for outputs in removed):
+						for src_file_path in self.cache.paths(target_path):
+							remove_source(
+								self.cache,
+								self.settings,
+								src_file_path,
+								matching_tool(self.index, self.tools, src_file_path)
 							)
+					continue
+
+				asset, asset_target_relative = self.index.find(target_path)
+				if asset is not None and os.path.sep not in asset_target_relative:
+					if os.path.isdir(target_path):
+						# a matched folder; bring all of it up to date
+						source_paths, copied = sync_tree(
+							self.cache,
+							self.settings,
+							target_path,
+							os.path.join(asset.abs_dst_folder, asset_target_relative)
+						)
+						if copied:
+							self.notify(asset, asset_target_relative)
+						continue
+				else:
+					# a file inside a matched folder
+					asset, folder = self.index.find_bundle(target_path)
+					if asset is None:
+						continue
 
-							# get the relative asset path from the source_root
-							# to the asset being modified.
-							relative_path = os.path.relpath(outputs[0], settings.paths.destination_root)
-
-							if self.send_reload_requests:
-								request_packet = {
-									"type": "file_modified",
-									"resource": relative_path
-								}
-								
-								post = 80
-								host, uri = self.server_url.split("/")
-								if ":" in host:
-									host, port = host.split(":")
-									port = int(port)
-
-								try:
-									connection = httplib.HTTPConnection(host, port)
-									connection.request("PUT", ("/" + uri), json.dumps(request_packet))
-									response = connection.getresponse()
-									if response.status != 204 and response.status != 200:
-										logging.warn("Request failed: (%i) %s" % (response.status, response.reason))				
-								except socket.error as exception:
-									pass
-								except:
-									raise
-							break
-						except:
-							raise
+					relative_path = os.path.relpath(target_path, asset.abs_src_folder)
+					if os.path.isfile(target_path) and not os.path.islink(target_path):
+						dst_file_path = os.path.join(asset.abs_dst_folder, relative_path)
+						make_dirs(os.path.dirname(dst_file_path))
+						if sync_file(
+							self.cache,
+							self.settings,
+							target_path,
+							dst_file_path
+						):
+							self.notify(asset, relative_path)
+					else:
+						# links and new folders
+						source_paths, copied = sync_tree(
+							self.cache,
+							self.settings,
+							os.path.join(asset.abs_src_folder, folder),
+							os.path.join(asset.abs_dst_folder, folder)
+						)
+						if copied:
+							self.notify(asset, folder)
+					continue
+
+				# every mask matching the file builds it, each with
+				# its own cache entry (see scan_asset_folders)
+				masks = [
+					match for match, relative_path in
+					self.index.find_all(target_path)
+					if os.path.sep not in relative_path
+				]
+				for asset in masks:
+					mask = asset.glob if len(masks) > 1 else None
+					self.build(asset, target_path, mask)
+
+		def build(self, asset, target_path, mask):
+			if self.tools.has_key(asset.tool):
+				tool = tools[asset.tool]
+			else:
+				raise UnknownToolException(
+					"Unknown tool \"%s\"" % asset.tool
+				)
+
+			commands = resolve_commands(
+				self.tools,
+				tool,
+				self.settings.paths,
+				asset,
+				target_path,
+				self.platform
+			)
+			recipe = hash_commands(
+				tool, self.platform, commands, self.settings.paths
+			)
+
+			# try to update the cache
+			cache_path = Cache.mask_path(target_path, mask)
+			if not self.cache.update(cache_path, recipe, dirty=True):
+				return
+
+			with self.lock:
+				self.active[target_path] = self.active.get(target_path, 0) + 1
+
+			index = self.pool.submit_limited(
+				tool.name,
+				tool.max_jobs,
+				tool.cost,
+				self.convert,
+				tool,
+				asset,
+				target_path,
+				commands
+			)
+			self.job_paths[index] = cache_path
+
+		def convert(self, tool, asset, target_path, commands):
+			try:
+				make_dirs(asset.abs_dst_folder)
+				outputs = list_outputs([(None, None, execute_commands(
+					self.tools, 
+					tool, 
+					self.settings.paths,
+					asset,
+					target_path,
+					self.platform,
+					commands=commands
+				))])
+			except ToolFailedException:
+				# already logged; the file stays dirty
+				return None
+			finally:
+				with self.lock:
+					self.active[target_path] -= 1
+					if not self.active[target_path]:
+						del self.active[target_path]
+					if target_path not in self.active and (
+						target_path in self.deferred
+					):
+						self.deferred.discard(target_path)
+						self.queue.put(target_path)
+
+			missing_outputs = [
+				output for output in outputs if not os.path.lexists(output)
+			]
+			if missing_outputs:
+				logging.error(
+					"ERROR %s did not produce %s" %
+					(target_path, ", ".join(missing_outputs))
+				)
+				return None
+
+			# get the relative asset path from the source_root
+			# to the asset being modified.
+			if self.notifier and outputs:
+				self.notifier.notify(os.path.relpath(
+					outputs[0], settings.paths.destination_root
+				))
+			if consumes_source(tool):
+				return []
+			return outputs
+
+		def notify(self, asset, relative_path):
+			# relative_path is relative to the asset's destination folder
+			if self.notifier:
+				self.notifier.notify(os.path.relpath(
+					os.path.join(asset.abs_dst_folder, relative_path),
+					self.settings.paths.destination_root
+				))
+
+		def stop(self):
+			# jobs that haven't started are picked up on the next run
+			self.pool.join(cancel=True)
+			self.collect()
+			if self.notifier:
+				self.notifier.stop()
 
 	logging.info("Monitoring assets in: %s..." % settings.paths.source_root)
 
@@ -280,27 +727,27 @@ def monitor_assets(
 		asset_folders,
 		tools,
 		platform,
-		server_url
+		server_url,
+		jobs
 	)
 
-	observer = Observer()
+	if watcher == "poll" or Observer is None:
+		observer = PollingWatcher(asset_folders, poll_interval, poll_rate)
+	else:
+		observer = Observer()
 	observer.schedule(event_handler, settings.paths.source_root, recursive=True)
 	observer.start()
 
-	import time
-	import sys
 	try:
 		while True:
-			# Wait some time for events to trickle in and file i/o
-			# to complete
-			time.sleep(2)
-
-			# handle events that have been queued
-			event_handler.process_events()
+			# wakes as soon as events are queued; the timeout only
+			# bounds how long finished jobs wait to be collected.
+			event_handler.wait_for_events()
 	except KeyboardInterrupt:
 		observer.stop()
 
 	observer.join()
+	event_handler.stop()
 
 
 def iterate_assets(
@@ -308,80 +755,529 @@ def iterate_assets(
 		settings, 
 		asset_folders,
 		tools, 
-		platform
+		platform,
+		jobs = 1,
+		trace = None,
+		shard = None,
+		store = None,
+		budget = None
 	):
 	# loop through each asset path and glob
 	# run the tool associated with each file
 	logging.info("Running tools on assets...")
 	total_files = 0
 	modified_files = 0
-	for asset in asset_folders:
+	restored_files = 0
+	failed_paths = []
+
+	# Tools are run on the worker pool, but the cache is only
+	# touched from this thread. When running in parallel, each
+	# job's log is buffered and replayed once the job finishes.
+	# Each tool's jobs are limited by its max_jobs and cost.
+	pool = WorkerPool(jobs, budget)
+	job_logs = {}
+
+	# the cache paths (see Cache.mask_path) each job builds
+	job_paths = {}
+	job_store_keys = {}
+	job_tools = {}
+
+	# When running in parallel, stale work is collected first and
+	# started longest expected job first, so slow jobs don't start
+	# last and stretch the build.
+	scheduled = []
+
+	def run_job(*args):
+		start = time.time()
 		try:
-			search_path = os.path.join(
-				asset.abs_src_folder, 
-				asset.glob
-			)
-			#logging.info("Processing: \"%s\"" % search_path)
-			
-			if tools.has_key(asset.tool):
-				tool = tools[asset.tool]
-			else:
-				raise UnknownToolException(
-					"Unknown tool \"%s\"" % asset.tool
+			outputs = execute_commands(*args)
+		except ToolFailedException:
+			# already logged with the rest of the job's output
+			outputs = None
+		return outputs, time.time() - start
+
+	def report_completed(block=False):
+		for index, (outputs, duration) in pool.completed(block):
+			log = job_logs.pop(index, None)
+			if log:
+				log.flush()
+
+			# files stay dirty in the cache until their
+			# tools succeed and produce every output.
+			paths = job_paths.pop(index)
+			store_keys = job_store_keys.pop(index)
+			tool, size = job_tools.pop(index)
+			if outputs is None:
+				failed_paths.extend(paths)
+				continue
+
+			cache.record_tool_duration(tool.name, duration, size)
+
+			file_outputs = split_outputs(outputs, len(paths))
+			for path, path_outputs in zip(paths, file_outputs):
+				missing_outputs = [
+					output for output in path_outputs
+					if not os.path.lexists(output)
+				]
+				if missing_outputs:
+					logging.error(
+						"ERROR %s did not produce %s" %
+						(Cache.describe(path), ", ".join(missing_outputs))
+					)
+					failed_paths.append(path)
+					continue
+
+				# record the outputs and build time of each file; the time
+				# is used to estimate how long the next build will take.
+				if not consumes_source(tool):
+					record_outputs(cache, settings, path, path_outputs)
+				cache.set_duration(path, duration / len(paths))
+				cache.set_dirty(path, False)
+				if path in store_keys:
+					store.put(store_keys[path], path_outputs)
+
+	def dispatch(tool, asset, paths, commands, store_keys, estimate, size):
+		job = (tool, asset, paths, commands, store_keys, size)
+		if pool.threads:
+			scheduled.append((estimate, job))
+		else:
+			submit(*job)
+
+	def submit(tool, asset, paths, commands, store_keys, size):
+		log = logging
+		if pool.threads:
+			log = BufferedLog()
+
+		index = pool.submit_limited(
+			tool.name,
+			tool.max_jobs,
+			tool.cost,
+			run_job,
+			tools, 
+			tool, 
+			settings.paths,
+			asset,
+			Cache.file_path(paths[0]),
+			platform,
+			{},
+			log,
+			commands,
+			trace
+		)
+		job_paths[index] = paths
+		job_store_keys[index] = store_keys
+		job_tools[index] = (tool, size)
+		if log is not logging:
+			job_logs[index] = log
+		report_completed()
+
+	# list each source folder once for all of the masks
+	scanned_assets = scan_asset_folders(asset_folders)
+
+	# files the cache knows about that are no longer found here
+	# were deleted, renamed or left their asset entry. Files inside
+	# matched folders are handled by sync_tree.
+	source_names = {}
+	matched_folders = []
+	for asset, (files, matched_subs) in scanned_assets.iteritems():
+		names = source_names.setdefault(asset.abs_src_folder, set())
+		offset = len(os.path.join(asset.abs_src_folder, ""))
+		names.update(
+			Cache.mask_path(src_file_path, mask)[offset:]
+			for src_file_path, stat, mask in files
+		)
+		matched_folders.extend(
+			os.path.join(asset.abs_src_folder, folder)
+			for folder in matched_subs
+		)
+
+	try:
+		for asset in asset_folders:
+			try:
+				search_path = os.path.join(
+					asset.abs_src_folder, 
+					asset.glob
 				)
+				#logging.info("Processing: \"%s\"" % search_path)
+				
+				if tools.has_key(asset.tool):
+					tool = tools[asset.tool]
+				else:
+					raise UnknownToolException(
+						"Unknown tool \"%s\"" % asset.tool
+					)
 
-			path_created = False
+				if asset not in scanned_assets:
+					continue
 
-			for root, subs, files in os.walk(asset.abs_src_folder, topdown=True):
-				# filter files based on glob
-				files[:] = fnmatch.filter(files, asset.glob)
+				# make all asset destination folders
+				make_dirs(asset.abs_dst_folder)
 
-				if not path_created:
-					# make all asset destination folders
-					make_dirs(asset.abs_dst_folder)
-					path_created = True
+				files, matched_subs = scanned_assets[asset]
 
-				# filter subdirectories based on the glob
-				matched_subs = fnmatch.filter(subs, asset.glob)
+				# One or more subdirectories matched the glob.
+				# Each match is synced to the destination folder.
+				# This is to specifically handle the case where directories are entire
+				# folders (.dSYM, .app). These specific dirs should be
+				# exceptions where the entire folder is simply copied.
+				for folder in matched_subs:
+					src_folder_path = os.path.join(asset.abs_src_folder, folder)
+					if not in_shard(cache.key(src_folder_path), shard):
+						continue
 
-				# do not recurse into subdirectories
-				subs[:] = []
+					folder_paths, copied = sync_tree(
+						cache,
+						settings,
+						src_folder_path,
+						os.path.join(asset.abs_dst_folder, folder)
+					)
+					total_files += len(folder_paths)
+					modified_files += copied
+
+				# stale files waiting for a batch tool
+				batch = []
+				batch_store_keys = {}
+				batch_estimate = 0.0
+				batch_size = 0
 
-				if matched_subs:
-					# One or more subdirectories matched the glob.
-					# For now, copy each match over to the destination folder.
-					# This is to specifically handle the case where directories are entire
-					# folders (.dSYM, .app). These specific dirs should be
-					# exceptions where the entire folder is simply copied.
-					for folder in matched_subs:
-						copy_tree(source_file_root, dst_file_root)
+				for src_file_path, stat, mask in files:
+					if not in_shard(cache.key(src_file_path), shard):
+						continue
 
-				for file in files:
-					src_file_path = os.path.join(root, file)
+					# the file's entry for this asset mask
+					cache_path = Cache.mask_path(src_file_path, mask)
 
 					total_files += 1
 
-					if not cache.update(src_file_path):
+					commands = resolve_commands(
+						tools,
+						tool,
+						settings.paths,
+						asset,
+						src_file_path,
+						platform
+					)
+					recipe = hash_commands(
+						tool, platform, commands, settings.paths
+					)
+
+					if not cache.update(cache_path, recipe, stat, dirty=True):
 						continue
 
 					modified_files += 1
 
-					execute_commands(
-						tools, 
-						tool, 
+					# outputs built from the same source contents and
+					# commands before are restored from the store.
+					store_keys = {}
+					outputs = list_outputs(commands)
+					if store and outputs and not tool.builtin:
+						key = OutputStore.key(
+							cache.get_entry(cache_path)[Cache.ENTRY_DIGEST] or
+							hash_file(src_file_path),
+							recipe
+						)
+						if store.restore(key, outputs):
+							record_outputs(cache, settings, cache_path, outputs)
+							cache.set_dirty(cache_path, False)
+							restored_files += 1
+							continue
+						store_keys[cache_path] = key
+
+					estimate = cache.estimate_duration(
+						cache.get_entry(cache_path), tool.name, stat.st_size
+					)
+
+					if tool.batch_size:
+						batch.append(cache_path)
+						batch_store_keys.update(store_keys)
+						batch_estimate += estimate
+						batch_size += stat.st_size
+						if len(batch) < tool.batch_size:
+							continue
+
+						commands = resolve_batch_commands(
+							tools,
+							tool,
+							settings.paths,
+							asset,
+							[Cache.file_path(path) for path in batch],
+							platform
+						)
+						dispatch(
+							tool,
+							asset,
+							batch,
+							commands,
+							batch_store_keys,
+							batch_estimate,
+							batch_size
+						)
+						batch = []
+						batch_store_keys = {}
+						batch_estimate = 0.0
+						batch_size = 0
+						continue
+
+					dispatch(
+						tool,
+						asset,
+						[cache_path],
+						commands,
+						store_keys,
+						estimate,
+						stat.st_size
+					)
+
+				if batch:
+					commands = resolve_batch_commands(
+						tools,
+						tool,
 						settings.paths,
 						asset,
-						src_file_path,
+						[Cache.file_path(path) for path in batch],
 						platform
 					)
+					dispatch(
+						tool,
+						asset,
+						batch,
+						commands,
+						batch_store_keys,
+						batch_estimate,
+						batch_size
+					)
+
+			except UnknownToolException as e:
+				logging.warn(e.message)
+				continue	
 
-		except UnknownToolException as e:
-			logging.warn(e.message)
-			continue	
+		# the sort is stable, so equal estimates keep their order
+		scheduled.sort(key=lambda item: -item[0])
+		for estimate, job in scheduled:
+			submit(*job)
 
+		report_completed(block=True)
+	except:
+		# on errors and Ctrl-C, drop the jobs that haven't started
+		# and record those that finished; the rest stay dirty.
+		exc_info = sys.exc_info()
+		pool.join(cancel=True)
+		report_completed()
+		raise exc_info[0], exc_info[1], exc_info[2]
+	finally:
+		pool.join()
+
+	# look for them a source folder at a time, with range queries,
+	# rather than reading every key in the cache.
+	stale_paths = cache.paths_outside(source_names)
+	for folder, names in source_names.iteritems():
+		stale_paths.extend(
+			os.path.join(folder, name) for name in cache.child_names(folder)
+			if name not in names
+		)
+		# subfolders are only expected inside matched folders
+		# and the source folders of other asset entries
+		stale_paths.extend(cache.nested_paths(
+			folder,
+			matched_folders + [other for other in source_names if other != folder]
+		))
+
+	index = AssetMaskIndex(asset_folders)
+	removed_files = 0
+	for src_file_path in stale_paths:
+		if not in_shard(cache.key(Cache.file_path(src_file_path)), shard):
+			continue
+		if remove_source(
+			cache,
+			settings,
+			src_file_path,
+			matching_tool(index, tools, src_file_path)
+		):
+			removed_files += 1
 
 	logging.info("Complete.")
 	logging.info("Modified / Total - %i/%i" % (modified_files, total_files))
+	if removed_files:
+		logging.info("Removed the outputs of %i files" % removed_files)
+	if store:
+		logging.info("Restored %i files from the output store" % restored_files)
+	if failed_paths:
+		logging.error(
+			"%i files failed and will be rebuilt on the next run:" %
+			len(failed_paths)
+		)
+		for path in failed_paths:
+			logging.error("  %s" % Cache.describe(path))
+
+	if pool.num_workers > 1 and pool.queue_times:
+		# time jobs spent waiting for a worker, their tool's
+		# max_jobs or room in the budget
+		logging.info(
+			"%-32s %8s %10s %10s" %
+			("Queue", "Jobs", "Total (s)", "Max (s)")
+		)
+		for name, (count, total, longest) in sorted(
+			pool.queue_times.iteritems(), key=lambda item: -item[1][1]
+		):
+			logging.info(
+				"%-32s %8i %10.3f %10.3f" % (name, count, total, longest)
+			)
+
+	if trace:
+		trace.log_summary()
+
+	return len(failed_paths)
+
+def status_assets(
+		cache,
+		settings,
+		asset_folders,
+		tools,
+		platform,
+		jobs = 1,
+		shard = None
+	):
+	"""
+		Find the assets that are out of date without running any
+		tools or writing to the cache.
+
+		Returns a dict describing the stale files of each asset entry,
+		with an estimate of how long rebuilding them will take (see
+		Cache.estimate_duration).
+	"""
+	assets = []
+	total_files = 0
+	stale_files = 0
+	estimated_seconds = 0.0
+
+	scanned_assets = scan_asset_folders(asset_folders)
+
+	for asset in asset_folders:
+		if asset.tool not in tools:
+			logging.warn("Unknown tool \"%s\"" % asset.tool)
+			continue
+		tool = tools[asset.tool]
+
+		files, matched_subs = scanned_assets.get(asset, ([], []))
+		files = [
+			(src_file_path, stat, mask) for src_file_path, stat, mask in files
+			if in_shard(cache.key(src_file_path), shard)
+		]
+		stale = []
+		asset_seconds = 0.0
+		for src_file_path, stat, mask in files:
+			cache_path = Cache.mask_path(src_file_path, mask)
+			commands = resolve_commands(
+				tools,
+				tool,
+				settings.paths,
+				asset,
+				src_file_path,
+				platform
+			)
+			recipe = hash_commands(
+				tool, platform, commands, settings.paths
+			)
+			status, entry = cache.compare(cache_path, recipe, stat)
+			if status == Cache.CACHE_IS_NEWER:
+				continue
+
+			duration = cache.estimate_duration(
+				cache.get_entry(cache_path), tool.name, stat.st_size
+			)
+			asset_seconds += duration
+			stale.append((
+				Cache.ALTER_TABLE[status],
+				os.path.relpath(src_file_path, asset.abs_src_folder),
+				duration
+			))
+
+		# files inside matched folders are synced one at a time
+		asset_total = len(files)
+		for folder in matched_subs:
+			src_folder_path = os.path.join(asset.abs_src_folder, folder)
+			if not in_shard(cache.key(src_folder_path), shard):
+				continue
+
+			folder_paths, changes = compare_tree(
+				cache,
+				src_folder_path,
+				os.path.join(asset.abs_dst_folder, folder)
+			)
+			asset_total += len(folder_paths)
+			for status, src_file_path in changes:
+				duration = 0.0
+				if status != Cache.CACHE_REMOVED:
+					duration = cache.estimate_duration(
+						cache.get_entry(src_file_path),
+						"copy",
+						os.lstat(src_file_path).st_size
+					)
+				asset_seconds += duration
+				stale.append((
+					Cache.ALTER_TABLE[status],
+					os.path.relpath(src_file_path, asset.abs_src_folder),
+					duration
+				))
+
+		total_files += asset_total
+		stale_files += len(stale)
+		estimated_seconds += asset_seconds
+
+		if stale:
+			assets.append({
+				"mask": os.path.join(asset.src_folder, asset.glob),
+				"tool": asset.tool,
+				"total": asset_total,
+				"stale": [
+					{"status": status, "path": path, "estimated_seconds": seconds}
+					for status, path, seconds in stale
+				],
+				"estimated_seconds": asset_seconds
+			})
+
+	logging.info(
+		"Stale / Total - %i/%i (estimated %.1fs with %i jobs)" %
+		(stale_files, total_files, estimated_seconds / jobs, jobs)
+	)
+
+	return {
+		"platform": platform,
+		"total": total_files,
+		"stale": stale_files,
+		"estimated_seconds": estimated_seconds,
+		"estimated_wall_seconds": estimated_seconds / jobs,
+		"assets": assets
+	}
+
+def merge_shards(cache, settings, shards):
+	"""
+		Merge the caches and outputs of sharded builds (see --shard).
+		shards is a list of (cache path, destination root) pairs; each
+		destination tree is copied over settings.paths.destination_root.
+	"""
+	destination_root = settings.paths.destination_root
+	for shard_cache_path, shard_destination_root in shards:
+		count = cache.merge(os.path.abspath(shard_cache_path))
+
+		copied = 0
+		for root, folders, names in os.walk(shard_destination_root):
+			target_root = os.path.join(
+				destination_root,
+				os.path.relpath(root, shard_destination_root)
+			)
+			make_dirs(target_root)
+			for name in names:
+				copy_file(
+					os.path.join(root, name),
+					os.path.join(target_root, name)
+				)
+				copied += 1
+
+		logging.info(
+			"Merged %i cache entries and %i outputs from %s" %
+			(count, copied, shard_cache_path)
+		)
 
 def main():
 	commands = {}
@@ -417,12 +1313,64 @@ def main():
 		"--source_root",
 		dest="source_root"
 	)
+	p.add_argument(
+		"-f",
+		"--fingerprint",
+		dest="fingerprint",
+		action="store_true",
+		help="Only rebuild files whose contents changed, not just their timestamps"
+	)
+	p.add_argument(
+		"-j",
+		"--jobs",
+		dest="jobs",
+		type=int,
+		default=1,
+		help="Number of tool invocations to run in parallel (0 = one per CPU)"
+	)
+
+	p.add_argument(
+		"--trace",
+		dest="trace_path",
+		metavar="TRACE_FILE_PATH",
+		help="Write a Chrome trace of every command run and log a timing summary"
+	)
+
+	p.add_argument(
+		"--status",
+		dest="status",
+		action="store_true",
+		help="Print the out of date assets as JSON without building them"
+	)
+
+	p.add_argument(
+		"--shard",
+		dest="shard",
+		metavar="i/N",
+		help="Only build the i-th of N partitions of the files"
+	)
+	p.add_argument(
+		"--merge",
+		dest="merge",
+		nargs=2,
+		action="append",
+		metavar=("SHARD_CACHE_PATH", "SHARD_DESTINATION_ROOT"),
+		help="Merge the cache and outputs of a sharded build, then exit"
+	)
 
 	args = p.parse_args()
-	config_cache = KeyValueCache()
+	if args.jobs < 1:
+		args.jobs = multiprocessing.cpu_count()
 
-	# load config
-	config_data = load_config(args.config_path, config_cache)
+	shard = None
+	if args.shard:
+		try:
+			shard = parse_shard(args.shard)
+		except ValueError as e:
+			p.error(e.message)
+
+	# load config; --status leaves everything on disk as it was
+	config_data = load_resolved_config(args.config_path, not args.status)
 	
 	# the source_root can be specified on the command line;
 	# this properly inserts it into the paths dict
@@ -453,10 +1401,6 @@ def main():
 		)
 	)
 
-	# get cache path
-	cache = Cache(args.config_path, remove=args.clear_cache)
-	cache.load()
-
 	# conform all paths
 	if getattr(config, "paths", None):
 		base_path = os.path.dirname(os.path.abspath(args.config_path))
@@ -466,6 +1410,16 @@ def main():
 		
 		setattr(settings, "paths", AttributeStore(config.paths))
 
+	# get cache path; entries are keyed relative to the source_root
+	cache = Cache(
+		args.config_path,
+		remove=args.clear_cache and not args.status,
+		fingerprint=args.fingerprint,
+		source_root=settings.paths.source_root,
+		destination_root=settings.paths.destination_root
+	)
+	cache.load(args.status)
+
 
 	# parse all tools
 	Tool.load_tools(
@@ -490,34 +1444,113 @@ def main():
 		asset_folders.append(asset_folder)
 	logging.info("Loaded %i asset folders." % len(asset_folders))
 
+	# report substitution errors now, rather than mid-build
+	for asset_folder in asset_folders:
+		if asset_folder.tool in tools:
+			validate_tool_templates(
+				tools,
+				tools[asset_folder.tool],
+				settings.paths,
+				asset_folder,
+				args.platform
+			)
+
+	# outputs are restored from the store, when one is configured
+	store = None
+	if hasattr(config, "store") and not args.status:
+		if not "path" in config.store:
+			raise Exception("Store block requires a \"path\" parameter")
+
+		store = OutputStore(
+			os.path.join(
+				os.path.dirname(os.path.abspath(args.config_path)),
+				config.store["path"]
+			),
+			config.store.get("max_size", 1024) * 1024 * 1024,
+			config.store.get("method", "copy")
+		)
+		store.open()
+
+	# resources shared by the jobs of tools that declare a cost;
+	# the machine's cores and memory unless the config says otherwise
+	budget = {"cpu": multiprocessing.cpu_count()}
+	memory = get_physical_memory()
+	if memory:
+		budget["memory"] = memory
+	if hasattr(config, "budget"):
+		budget.update(config.budget)
+
 	# check if we need to enter monitoring mode
 	monitor_mode = hasattr(config, "monitor")
-	if monitor_mode:
-		monitor = config.monitor
-		if not "url" in monitor:
-			raise Exception("Monitor block requires a \"url\" parameter")
+	try:
+		if args.merge:
+			merge_shards(cache, settings, args.merge)
+		elif args.status:
+			status = status_assets(
+				cache,
+				settings,
+				asset_folders,
+				tools,
+				args.platform,
+				args.jobs,
+				shard
+			)
+			print json.dumps(status, indent=4, sort_keys=True)
+		elif monitor_mode:
+			if shard:
+				raise Exception("--shard cannot be used with a monitor block")
 
-		# run monitoring
-		monitor_assets(
-			cache,
-			settings,
-			asset_folders,
-			tools,
-			args.platform,
-			monitor["url"]
-		)
-	else:
-		# just run through all assets
-		iterate_assets(
-			cache,
-			settings,
-			asset_folders,
-			tools, 
-			args.platform
-		)
+			monitor = config.monitor
+			if not "url" in monitor:
+				raise Exception("Monitor block requires a \"url\" parameter")
+
+			# run monitoring
+			monitor_assets(
+				cache,
+				settings,
+				asset_folders,
+				tools,
+				args.platform,
+				monitor["url"],
+				args.jobs,
+				monitor.get("settle", 0.05),
+				monitor.get("notify_window", 0.05),
+				monitor.get("watcher", None),
+				monitor.get("poll_interval", 1.0),
+				monitor.get("poll_rate", None),
+				budget
+			)
+		else:
+			trace = None
+			if args.trace_path:
+				trace = BuildTrace()
+
+			# just run through all assets
+			failures = iterate_assets(
+				cache,
+				settings,
+				asset_folders,
+				tools, 
+				args.platform,
+				args.jobs,
+				trace,
+				shard,
+				store,
+				budget
+			)
 
-	# write cache to file
-	cache.save()
+			if trace:
+				trace.write_chrome_trace(args.trace_path)
+
+			if failures:
+				sys.exit(1)
+	finally:
+		# write any pending cache entries; earlier entries were
+		# committed as the build progressed.
+		if not args.status:
+			cache.save()
+		if store:
+			store.save()
 
 if __name__ == "__main__":
 	# initialize logging
@@ -1,14 +1,28 @@
 import os
+import collections
 import fnmatch
+import hashlib
+import httplib
 import json
 import logging
+import re
 import shutil
 import shlex
+import socket
+import sqlite3
 import subprocess
+import sys
+import threading
+import time
+import urlparse
 
 from util import (
+	copy_file,
 	get_platform,
 	get_supported_platforms,
+	hash_file,
+	list_directory,
+	make_dirs,
 	run_as_shell
 )
 
@@ -18,6 +32,9 @@ from util import (
 class UnknownToolException(Exception):
 	pass
 
+class ToolFailedException(Exception):
+	pass
+
 
 #
 # Classes
@@ -30,6 +47,10 @@ class AssetFolderMask(object):
 		self.tool = kwargs.get("tool", None)
 		self.params = kwargs.get("params", {})
 		self.abs_regex = None
+		self.glob_regex = re.compile(fnmatch.translate(self.glob))
+
+		# see compile_params
+		self.compiled_params = {}
 
 	def make_folders_absolute(self, asset_source_path, asset_destination_path):
 		self.abs_src_folder = os.path.join(
@@ -39,6 +60,9 @@ class AssetFolderMask(object):
 			asset_destination_path, self.dst_folder
 		)
 
+	def match(self, name):
+		return self.glob_regex.match(name) is not None
+
 	def get_abs_regex(self):
 		if not self.abs_regex:
 			self.abs_regex = fnmatch.translate(
@@ -46,6 +70,79 @@ class AssetFolderMask(object):
 			)
 		return self.abs_regex
 
+class AssetMaskIndex(object):
+	"""
+		Finds the asset mask responsible for an absolute path.
+
+		Masks are indexed by their absolute source folder, so only the
+		masks whose folder is an ancestor of the path are considered.
+		Candidates are cached per directory and tried in config order,
+		matching the first-match behavior of a linear scan.
+	"""
+	def __init__(self, asset_folders):
+		self.masks_by_folder = {}
+		for order, asset in enumerate(asset_folders):
+			self.masks_by_folder.setdefault(
+				asset.abs_src_folder, []
+			).append((order, asset))
+		self.candidates = {}
+
+	def get_candidates(self, directory):
+		if directory in self.candidates:
+			return self.candidates[directory]
+
+		candidates = []
+		folder = directory
+		while True:
+			candidates.extend(self.masks_by_folder.get(folder, []))
+			parent = os.path.dirname(folder)
+			if parent == folder:
+				break
+			folder = parent
+
+		candidates.sort()
+		candidates = [asset for order, asset in candidates]
+		self.candidates[directory] = candidates
+		return candidates
+
+	def find(self, abs_path):
+		"""
+			Return (asset, relative_path) for the first mask matching
+			abs_path, where relative_path is relative to the mask's
+			source folder. Return (None, None) if nothing matches.
+		"""
+		for asset in self.get_candidates(os.path.dirname(abs_path)):
+			relative_path = abs_path[len(asset.abs_src_folder) + 1:]
+			if asset.match(relative_path):
+				return asset, relative_path
+		return None, None
+
+	def find_all(self, abs_path):
+		"""
+			Like find, but return a list of (asset, relative_path) for
+			every mask matching abs_path, in config order.
+		"""
+		matches = []
+		for asset in self.get_candidates(os.path.dirname(abs_path)):
+			relative_path = abs_path[len(asset.abs_src_folder) + 1:]
+			if asset.match(relative_path):
+				matches.append((asset, relative_path))
+		return matches
+
+	def find_bundle(self, abs_path):
+		"""
+			Return (asset, folder) when abs_path is inside a folder that
+			is matched by a mask as a whole (such as an .app bundle),
+			where folder is relative to the mask's source folder.
+			Return (None, None) otherwise.
+		"""
+		for asset in self.get_candidates(os.path.dirname(abs_path)):
+			relative_path = abs_path[len(asset.abs_src_folder) + 1:]
+			folder = relative_path.split(os.sep)[0]
+			if folder != relative_path and asset.match(folder):
+				return asset, folder
+		return None, None
+
 class AttributeStore(object):
 	def __init__(self, *initial_data, **kwargs):
 		for dictionary in initial_data:
@@ -82,88 +179,1710 @@ class AttributeStore(object):
 			logging.info("%s -> %s" % (key, value))
 
 class Cache(object):
-	CACHE_EXTENSION = "cache"
+	CACHE_EXTENSION = "cache.db"
+
+	# caches from older versions were a single JSON file
+	LEGACY_CACHE_EXTENSION = "cache"
+
+	# pending entries are committed after this many updates
+	# or seconds, whichever comes first.
+	COMMIT_INTERVAL = 256
+	COMMIT_SECONDS = 1.0
+
+	# entries are read a directory at a time, and up to this many
+	# are held in memory.
+	PREFETCH_LIMIT = 1 << 16
+
+	# tool timings are halved after this many jobs,
+	# so recent runs carry more weight.
+	TOOL_HISTORY = 1000
+
+	# estimate for files of tools that have never run
+	DEFAULT_SECONDS_PER_BYTE = 1e-8
 
 	CACHE_ADDED = 0
 	CACHE_UPDATED = 1
 	CACHE_IS_NEWER = 2
+	CACHE_REMOVED = 3
 
 
 	ALTER_TABLE = {
 		CACHE_ADDED: "A", # added
 		CACHE_UPDATED: "M", # modified
-		CACHE_IS_NEWER: "O"  # ignored
+		CACHE_IS_NEWER: "O",  # ignored
+		CACHE_REMOVED: "D" # deleted
 	}	
 
-	def __init__(self, relative_config_path, remove=False):
+	# each cache entry is a list of
+	# [mtime, size, inode, digest, recipe, duration, outputs, dirty]
+	ENTRY_MTIME = 0
+	ENTRY_SIZE = 1
+	ENTRY_INODE = 2
+	ENTRY_DIGEST = 3
+	ENTRY_RECIPE = 4
+	ENTRY_DURATION = 5
+	ENTRY_OUTPUTS = 6
+	ENTRY_DIRTY = 7
+	ENTRY_LENGTH = 8
+
+	# columns added after the first sqlite cache; added to older caches
+	# when they are opened.
+	ADDED_COLUMNS = [
+		("duration", "REAL"),
+		("outputs", "TEXT"),
+		("dirty", "INTEGER")
+	]
+
+	# the schema changes in migrate are applied once, and recorded
+	# in the database's user_version.
+	SCHEMA_VERSION = 2
+
+	# a file matched by several asset masks has an entry per mask,
+	# stored under its path followed by this and the mask's glob.
+	MASK_SEPARATOR = "\0"
+
+	def __init__(
+			self,
+			relative_config_path,
+			remove=False,
+			fingerprint=False,
+			source_root=None,
+			destination_root=None
+		):
 		# derive the cache path from the relative relative_config path
-		relative_cache_path = os.path.splitext(
-			relative_config_path
-		)[0] + ".%s" % Cache.CACHE_EXTENSION
+		relative_base_path = os.path.splitext(relative_config_path)[0]
 	
 		# init variables
-		self.abs_cache_path = os.path.abspath(relative_cache_path)
-		self.cache = {}
+		self.abs_cache_path = os.path.abspath(
+			relative_base_path + ".%s" % Cache.CACHE_EXTENSION
+		)
+		self.abs_legacy_cache_path = os.path.abspath(
+			relative_base_path + ".%s" % Cache.LEGACY_CACHE_EXTENSION
+		)
+		self.connection = None
+		self.pending = {}
+		self.last_commit = time.time()
+
+		# directory key -> {name: entry tuple}, least recently used first.
+		# Directory prefixes are only stored once, as the keys.
+		self.directories = collections.OrderedDict()
+		self.prefetched = 0
+		self.last_directory = None
+		self.last_entries = None
+
+		# tool name -> [seconds, bytes, jobs] of past runs
+		self.tool_stats = {}
+		self.pending_tools = set()
+
+		# when set, files whose stat changed are hashed and only
+		# reported as modified if their contents differ.
+		self.fingerprint = fingerprint
+
+		# when set, entries are keyed by paths relative to source_root,
+		# so that caches built on other machines can be merged.
+		self.source_root = source_root
+
+		# likewise, outputs are stored relative to destination_root
+		self.destination_root = destination_root
 
 		# remove if requested
 		if remove:
 			self.remove()
 
-	def load(self):
-		if os.path.exists(self.abs_cache_path):
-			logging.info("Reading cache from %s..." % self.abs_cache_path)
-			with open(self.abs_cache_path, "rb") as file:
-				self.cache = json.load(file)
-				file.close()
+	def load(self, read_only=False):
+		"""
+			Open the cache database. Entries are read on demand,
+			so this does not depend on the size of the cache.
+
+			With read_only set, nothing is written to disk. A cache
+			that is missing, or would need migrating, is read into
+			memory and changed there instead.
+		"""
+		start = time.time()
+		is_new = not os.path.exists(self.abs_cache_path)
+
+		logging.info("Reading cache from %s..." % self.abs_cache_path)
+		if read_only:
+			self.connection = self.open_read_only(is_new)
+			if self.connection.execute("PRAGMA query_only").fetchone()[0]:
+				self.load_tool_stats()
+				logging.info("Opened cache in %.3fs" % (time.time() - start))
+				return
+		else:
+			self.connection = sqlite3.connect(self.abs_cache_path)
+			self.connection.execute("PRAGMA journal_mode=WAL")
+			self.connection.execute("PRAGMA synchronous=NORMAL")
+
+		# byte strings take a quarter of the memory of unicode ones
+		# in entries held by get_directory.
+		self.connection.text_factory = str
+		self.connection.execute(
+			"CREATE TABLE IF NOT EXISTS entries ("
+			"path TEXT PRIMARY KEY, mtime REAL, size INTEGER, "
+			"inode INTEGER, digest TEXT, recipe TEXT, duration REAL, "
+			"outputs TEXT, dirty INTEGER)"
+		)
+
+		self.connection.execute(
+			"CREATE TABLE IF NOT EXISTS tools ("
+			"name TEXT PRIMARY KEY, seconds REAL, bytes REAL, jobs INTEGER)"
+		)
+
+		# the sources that list each output, mirroring the outputs column
+		self.connection.execute(
+			"CREATE TABLE IF NOT EXISTS outputs ("
+			"output TEXT, source TEXT, PRIMARY KEY (output, source))"
+		)
+		self.connection.execute(
+			"CREATE INDEX IF NOT EXISTS outputs_source ON outputs (source)"
+		)
+
+		version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+		if version < Cache.SCHEMA_VERSION:
+			self.migrate(version)
+		self.connection.commit()
+
+		self.load_tool_stats()
+
+		if is_new and os.path.exists(self.abs_legacy_cache_path):
+			self.import_legacy_cache()
+
+		logging.info("Opened cache in %.3fs" % (time.time() - start))
+
+	def open_read_only(self, is_new):
+		"""
+			Returns a connection that cannot change the cache on disk:
+			a query_only connection to a current cache, or otherwise
+			an in-memory copy of it.
+		"""
+		if is_new:
+			return sqlite3.connect(":memory:")
+
+		connection = sqlite3.connect(self.abs_cache_path)
+		connection.text_factory = str
+		connection.execute("PRAGMA query_only = ON")
+		version = connection.execute("PRAGMA user_version").fetchone()[0]
+		if version >= Cache.SCHEMA_VERSION:
+			return connection
+
+		memory = sqlite3.connect(":memory:")
+		memory.text_factory = str
+		memory.executescript("\n".join(connection.iterdump()))
+		memory.execute("PRAGMA user_version = %i" % version)
+		connection.close()
+		return memory
+
+	def migrate(self, version):
+		"""
+			Upgrade a cache written with schema version to the
+			current SCHEMA_VERSION.
+		"""
+		if version < 1:
+			# add columns introduced after the cache was created
+			columns = [
+				row[1] for row in
+				self.connection.execute("PRAGMA table_info(entries)")
+			]
+			for name, column_type in Cache.ADDED_COLUMNS:
+				if name not in columns:
+					self.connection.execute(
+						"ALTER TABLE entries ADD COLUMN %s %s" % (name, column_type)
+					)
+
+			# older caches were keyed by absolute paths; without a
+			# source_root the keys stay absolute, so try again later.
+			if not self.source_root:
+				return
+			prefix = os.path.join(self.source_root, "")
+			self.connection.execute(
+				"UPDATE OR REPLACE entries SET path = substr(path, ?) "
+				"WHERE substr(path, 1, ?) = ?",
+				(len(prefix) + 1, len(prefix), prefix)
+			)
+
+		if version < 2:
+			self.connection.execute("DELETE FROM outputs")
+			self.index_outputs(self.connection.execute(
+				"SELECT path, outputs FROM entries WHERE outputs IS NOT NULL"
+			).fetchall())
+
+		self.connection.execute("PRAGMA user_version = %i" % Cache.SCHEMA_VERSION)
+
+	def import_legacy_cache(self):
+		logging.info("Importing cache from %s..." % self.abs_legacy_cache_path)
+		with open(self.abs_legacy_cache_path, "rb") as file:
+			legacy_cache = json.load(file)
+
+		# older caches only stored the modified time
+		# or a shorter entry.
+		for path, entry in legacy_cache.iteritems():
+			if type(entry) is float:
+				entry = [entry]
+			if len(entry) < Cache.ENTRY_LENGTH:
+				entry.extend([None] * (Cache.ENTRY_LENGTH - len(entry)))
+			self.pending[self.key(path)] = entry
+		self.commit()
 
 	def save(self):
+		start = time.time()
+		count = len(self.pending)
 		logging.info("Writing cache %s..." % self.abs_cache_path)
-		with open(self.abs_cache_path, "wb") as file:
-			file.write(json.dumps(self.cache, indent=4))
+		self.commit()
+		logging.info(
+			"Wrote %i cache entries in %.3fs" % (count, time.time() - start)
+		)
+
+	def commit(self):
+		if self.pending:
+			self.connection.executemany(
+				"INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+				[[path] + entry for path, entry in self.pending.iteritems()]
+			)
+			self.pending = {}
+
+		if self.pending_tools:
+			self.connection.executemany(
+				"INSERT OR REPLACE INTO tools VALUES (?, ?, ?, ?)",
+				[
+					[name] + self.tool_stats[name]
+					for name in self.pending_tools
+				]
+			)
+			self.pending_tools = set()
+
+		# also commits removed entries
+		self.connection.commit()
+		self.last_commit = time.time()
 
-	def update(self, abs_asset_path):
+	def merge(self, abs_shard_cache_path):
 		"""
-			Update the cache with the modified file time for
+			Copy the entries of another cache into this one.
+			Entries from the other cache replace existing ones.
+
+			Returns the number of entries merged.
+		"""
+		self.commit()
+		self.connection.execute(
+			"ATTACH DATABASE ? AS shard", (abs_shard_cache_path,)
+		)
+		try:
+			self.directories.clear()
+			self.prefetched = 0
+			self.last_directory = None
+			count = self.connection.execute(
+				"INSERT OR REPLACE INTO entries "
+				"SELECT path, mtime, size, inode, digest, recipe, duration, "
+				"outputs, dirty FROM shard.entries"
+			).rowcount
+
+			# shards may predate the outputs table
+			self.connection.execute(
+				"DELETE FROM outputs WHERE source IN "
+				"(SELECT path FROM shard.entries)"
+			)
+			self.index_outputs(self.connection.execute(
+				"SELECT path, outputs FROM shard.entries "
+				"WHERE outputs IS NOT NULL"
+			).fetchall())
+
+			# combine the tool timings of both caches
+			for name, seconds, size, jobs in self.connection.execute(
+				"SELECT name, seconds, bytes, jobs FROM shard.tools"
+			).fetchall():
+				stats = self.tool_stats.setdefault(name, [0.0, 0.0, 0])
+				stats[0] += seconds
+				stats[1] += size
+				stats[2] += jobs
+				self.pending_tools.add(name)
+			self.commit()
+		finally:
+			self.connection.execute("DETACH DATABASE shard")
+		return count
+
+	def key(self, abs_asset_path):
+		"""
+			Returns the key abs_asset_path is stored under.
+		"""
+		if not self.source_root:
+			return abs_asset_path
+		return Cache.relative_key(abs_asset_path, self.source_root)
+
+	@staticmethod
+	def relative_key(path, root):
+		# slicing is much cheaper than relpath for the usual case
+		# of a normalized path inside root.
+		prefix = os.path.join(root, "")
+		if path.startswith(prefix):
+			relative_path = path[len(prefix):]
+		else:
+			relative_path = os.path.relpath(path, root)
+		if os.sep != "/":
+			relative_path = relative_path.replace(os.sep, "/")
+		return relative_path
+
+	def split_key(self, key):
+		"""
+			Returns (directory, name) for key.
+		"""
+		separator = "/" if self.source_root else os.sep
+		directory, _, name = key.rpartition(separator)
+		return directory, name
+
+	@staticmethod
+	def mask_path(abs_asset_path, mask):
+		"""
+			Returns the path the entry of abs_asset_path is stored under
+			for the asset mask with glob mask (see scan_asset_folders).
+		"""
+		if mask is None:
+			return abs_asset_path
+		return abs_asset_path + Cache.MASK_SEPARATOR + mask
+
+	@staticmethod
+	def file_path(path):
+		"""
+			Returns the file a path from mask_path refers to.
+		"""
+		return path.partition(Cache.MASK_SEPARATOR)[0]
+
+	@staticmethod
+	def describe(path):
+		"""
+			Returns a path from mask_path in a form fit for logging.
+		"""
+		path, separator, mask = path.partition(Cache.MASK_SEPARATOR)
+		if not separator:
+			return path
+		return "%s (%s)" % (path, mask)
+
+	def get_directory(self, directory):
+		"""
+			Returns the entries of every file in directory, read with
+			a single query, as a dict of name -> entry tuple.
+		"""
+		# lookups usually come a directory at a time
+		if directory == self.last_directory:
+			return self.last_entries
+
+		entries = self.directories.pop(directory, None)
+		if entries is None:
+			# keys inside directory sort between "directory/" and
+			# "directory0", as "0" follows the separator.
+			separator = "/" if self.source_root else os.sep
+			prefix = directory + separator
+			rows = self.connection.execute(
+				"SELECT path, mtime, size, inode, digest, recipe, duration, "
+				"outputs, dirty FROM entries WHERE path >= ? AND path < ?",
+				(prefix, directory + chr(ord(separator) + 1))
+			)
+
+			entries = {}
+			for row in rows:
+				name = row[0][len(prefix):]
+				if separator not in name:
+					entries[name] = row[1:]
+
+			self.prefetched += len(entries)
+			while self.directories and (
+				self.prefetched > Cache.PREFETCH_LIMIT
+			):
+				evicted_directory, evicted = self.directories.popitem(last=False)
+				self.prefetched -= len(evicted)
+
+		self.directories[directory] = entries
+		self.last_directory = directory
+		self.last_entries = entries
+		return entries
+
+	def get_entry(self, abs_asset_path):
+		key = self.key(abs_asset_path)
+		if key in self.pending:
+			return self.pending[key]
+
+		directory, name = self.split_key(key)
+		if not directory:
+			row = self.connection.execute(
+				"SELECT mtime, size, inode, digest, recipe, duration, outputs, "
+				"dirty FROM entries WHERE path = ?",
+				(key,)
+			).fetchone()
+		else:
+			row = self.get_directory(directory).get(name)
+
+		if row is None:
+			return None
+		return list(row)
+
+	def set_entry(self, abs_asset_path, entry):
+		key = self.key(abs_asset_path)
+		self.pending[key] = entry
+
+		directory, name = self.split_key(key)
+		entries = self.directories.get(directory)
+		if entries is not None:
+			if name not in entries:
+				self.prefetched += 1
+			entries[name] = tuple(entry)
+
+		if len(self.pending) >= Cache.COMMIT_INTERVAL or (
+			time.time() - self.last_commit >= Cache.COMMIT_SECONDS
+		):
+			self.commit()
+
+	def update(self, abs_asset_path, recipe=None, stat=None, dirty=False):
+		"""
+			Update the cache with the stat information for
 			the file at abs_asset_path.
 
 			Return true if the abs_asset_path modtime is > the
-			cached modtime.
+			cached modtime. In fingerprint mode, return true if
+			the file's stat changed and its contents no longer
+			match the cached digest.
+
+			If a recipe (see hash_commands) is given, also return
+			true if it differs from the recipe the file was last
+			built with.
+
+			Pass stat to reuse a stat result the caller already has.
+
+			If dirty is set, a file that needs rebuilding is recorded as
+			dirty until set_dirty clears it, once its tools succeed.
+			Dirty files are always rebuilt.
 
 			Otherwise, return False
 		"""
+		status, entry = self.compare(abs_asset_path, recipe, stat)
+		if dirty and status != Cache.CACHE_IS_NEWER:
+			entry[Cache.ENTRY_DIRTY] = 1
+		if entry is not None:
+			self.set_entry(abs_asset_path, entry)
 
-		# get the new modified time
-		modtime = os.path.getmtime(abs_asset_path)
+		if status == Cache.CACHE_IS_NEWER:
+			return False
+
+		logging.info(
+			"%c -> %s" %
+			(Cache.ALTER_TABLE[status], Cache.describe(abs_asset_path))
+		)
+		return True
+
+	def compare(self, abs_asset_path, recipe=None, stat=None):
+		"""
+			Compare the file at abs_asset_path against the cache
+			without modifying it (see update).
 
-		# keep track of status
-		status = Cache.CACHE_ADDED
+			Returns (status, entry), where status is one of the CACHE_*
+			values and entry is the new cache entry to store, or None
+			if the cached entry is already current.
+		"""
+		file_path = Cache.file_path(abs_asset_path)
+		if stat is None:
+			stat = os.stat(file_path)
+		entry = self.get_entry(abs_asset_path)
+		digest = None
 
 		# compare that value to the cached value
 		# update if necessary
 		# 
-		if abs_asset_path in self.cache:
-			if modtime <= self.cache[abs_asset_path]:
-				status = Cache.CACHE_IS_NEWER
-				return False
-			else:
-				status = Cache.CACHE_UPDATED
-		else:
+		if entry is None:
 			status = Cache.CACHE_ADDED
+		elif entry[Cache.ENTRY_DIRTY] or Cache.recipe_changed(entry, recipe):
+			status = Cache.CACHE_UPDATED
+		elif self.fingerprint:
+			if entry[Cache.ENTRY_DIGEST] and Cache.stat_matches(entry, stat):
+				return Cache.CACHE_IS_NEWER, Cache.adopt_recipe(entry, recipe)
 
-		logging.info(
-			"%c -> %s" %
-			(Cache.ALTER_TABLE[status], abs_asset_path)
+			# the stat changed; fall back to the file contents.
+			# Entries without a digest were written in timestamp mode,
+			# so trust their modified time once and record the digest.
+			digest = hash_file(file_path)
+			if digest == entry[Cache.ENTRY_DIGEST] or (
+				entry[Cache.ENTRY_DIGEST] is None and
+				stat.st_mtime <= entry[Cache.ENTRY_MTIME]
+			):
+				return Cache.CACHE_IS_NEWER, Cache.make_entry(
+					stat,
+					digest,
+					entry[Cache.ENTRY_RECIPE] or recipe,
+					entry
+				)
+
+			status = Cache.CACHE_UPDATED
+		elif stat.st_mtime <= entry[Cache.ENTRY_MTIME]:
+			return Cache.CACHE_IS_NEWER, Cache.adopt_recipe(entry, recipe)
+		else:
+			status = Cache.CACHE_UPDATED
+
+		if self.fingerprint and digest is None:
+			digest = hash_file(file_path)
+
+		return status, Cache.make_entry(stat, digest, recipe, entry)
+
+	def load_tool_stats(self):
+		self.tool_stats = dict(
+			(row[0], list(row[1:])) for row in
+			self.connection.execute("SELECT name, seconds, bytes, jobs FROM tools")
 		)
 
-		self.cache[abs_asset_path] = modtime
-		if status == Cache.CACHE_IS_NEWER:
+	def record_tool_duration(self, tool_name, seconds, size):
+		"""
+			Record that a job of tool_name took seconds to convert
+			size bytes of source files.
+		"""
+		stats = self.tool_stats.setdefault(tool_name, [0.0, 0.0, 0])
+		stats[0] += seconds
+		stats[1] += size
+		stats[2] += 1
+		if stats[2] > Cache.TOOL_HISTORY:
+			stats[0] /= 2
+			stats[1] /= 2
+			stats[2] //= 2
+		self.pending_tools.add(tool_name)
+
+	def estimate_duration(self, entry, tool_name, size):
+		"""
+			Returns the expected build time in seconds of a file with
+			cache entry entry and size bytes, converted by tool_name.
+
+			This is the file's last build time if it has one. Otherwise
+			it is estimated from the tool's past time per byte or, for
+			tools that have never run, that of all tools.
+		"""
+		if entry is not None and entry[Cache.ENTRY_DURATION] is not None:
+			return entry[Cache.ENTRY_DURATION]
+
+		stats = self.tool_stats.get(tool_name)
+		if not stats or not stats[2]:
+			stats = [
+				sum(item[index] for item in self.tool_stats.itervalues())
+				for index in range(3)
+			]
+
+		seconds, total_size, jobs = stats
+		if total_size > 0:
+			return seconds * size / total_size
+		if jobs:
+			return seconds / jobs
+		return size * Cache.DEFAULT_SECONDS_PER_BYTE
+
+	def set_dirty(self, abs_asset_path, dirty):
+		"""
+			Mark abs_asset_path as dirty, or clear it once it was built.
+		"""
+		entry = self.get_entry(abs_asset_path)
+		if entry is not None:
+			entry[Cache.ENTRY_DIRTY] = 1 if dirty else None
+			self.set_entry(abs_asset_path, entry)
+
+	def set_duration(self, abs_asset_path, duration):
+		"""
+			Record how long the tools took to build abs_asset_path.
+		"""
+		entry = self.get_entry(abs_asset_path)
+		if entry is not None:
+			entry[Cache.ENTRY_DURATION] = duration
+			self.set_entry(abs_asset_path, entry)
+
+	def set_outputs(self, abs_asset_path, outputs):
+		"""
+			Record the outputs built from abs_asset_path.
+		"""
+		entry = self.get_entry(abs_asset_path)
+		if entry is not None:
+			entry[Cache.ENTRY_OUTPUTS] = json.dumps([
+				self.output_key(output) for output in outputs
+			])
+			self.set_entry(abs_asset_path, entry)
+
+			key = self.key(abs_asset_path)
+			self.connection.execute(
+				"DELETE FROM outputs WHERE source = ?", (key,)
+			)
+			self.index_outputs([(key, entry[Cache.ENTRY_OUTPUTS])])
+
+	def index_outputs(self, rows):
+		"""
+			Add (key, outputs JSON) rows to the outputs table.
+		"""
+		self.connection.executemany(
+			"INSERT OR IGNORE INTO outputs VALUES (?, ?)",
+			(
+				(output, key)
+				for key, outputs in rows
+				for output in json.loads(outputs)
+			)
+		)
+
+	def get_outputs(self, abs_asset_path):
+		"""
+			Returns the outputs last built from abs_asset_path.
+		"""
+		entry = self.get_entry(abs_asset_path)
+		if entry is None:
+			return []
+		return self.load_outputs(entry)
+
+	def load_outputs(self, entry):
+		if not entry[Cache.ENTRY_OUTPUTS]:
+			return []
+		return [
+			self.output_path(output)
+			for output in json.loads(entry[Cache.ENTRY_OUTPUTS])
+		]
+
+	def remove_entry(self, abs_asset_path):
+		"""
+			Forget abs_asset_path. Returns the outputs it was built into,
+			or None if it was not in the cache.
+		"""
+		entry = self.get_entry(abs_asset_path)
+		if entry is None:
+			return None
+
+		key = self.key(abs_asset_path)
+		self.pending.pop(key, None)
+		directory, name = self.split_key(key)
+		entries = self.directories.get(directory)
+		if entries is not None and name in entries:
+			del entries[name]
+			self.prefetched -= 1
+		self.connection.execute("DELETE FROM entries WHERE path = ?", (key,))
+		self.connection.execute("DELETE FROM outputs WHERE source = ?", (key,))
+		return self.load_outputs(entry)
+
+	def is_output_referenced(self, abs_output_path):
+		"""
+			Returns True if any entry lists abs_output_path as an output.
+		"""
+		return self.connection.execute(
+			"SELECT 1 FROM outputs WHERE output = ? LIMIT 1",
+			(self.output_key(abs_output_path),)
+		).fetchone() is not None
+
+	def folder_range(self, abs_folder):
+		"""
+			Returns (low, high), where the keys of the files inside
+			abs_folder are those with low <= key < high, or None
+			if abs_folder is the source_root.
+		"""
+		separator = "/" if self.source_root else os.sep
+		key = self.key(abs_folder).rstrip(separator)
+		if key in ("", os.curdir):
+			return None
+		# "0" follows the separator
+		return key + separator, key + chr(ord(separator) + 1)
+
+	@staticmethod
+	def exclude_ranges(low, high, excluded):
+		"""
+			Returns the parts of the key range low <= key < high not
+			covered by the (low, high) ranges in excluded. A bound of
+			None is open.
+		"""
+		ranges = []
+		for start, end in sorted(excluded):
+			if high is not None and start >= high:
+				break
+			if low is not None and end <= low:
+				continue
+			if low is None or start > low:
+				ranges.append((low, start))
+			if low is None or end > low:
+				low = end
+		if low is None or high is None or low < high:
+			ranges.append((low, high))
+		return ranges
+
+	def paths_in_ranges(self, ranges, nested_after=None):
+		"""
+			Returns the absolute paths of the files whose keys fall in
+			ranges (see exclude_ranges). If nested_after is given, only
+			keys with a separator past that many characters are included.
+		"""
+		self.commit()
+		separator = "/" if self.source_root else os.sep
+		paths = []
+		for low, high in ranges:
+			clauses = []
+			values = []
+			if low is not None:
+				clauses.append("path >= ?")
+				values.append(low)
+			if high is not None:
+				clauses.append("path < ?")
+				values.append(high)
+			if nested_after is not None:
+				clauses.append("instr(substr(path, ?), ?) > 0")
+				values.extend([nested_after + 1, separator])
+
+			query = "SELECT path FROM entries"
+			if clauses:
+				query += " WHERE " + " AND ".join(clauses)
+			paths.extend(
+				self.path(row[0])
+				for row in self.connection.execute(query, values)
+			)
+		return paths
+
+	def paths(self, abs_folder=None):
+		"""
+			Returns the absolute path of every file in the cache,
+			or of those inside abs_folder.
+		"""
+		key_range = None
+		if abs_folder is not None:
+			key_range = self.folder_range(abs_folder)
+		return self.paths_in_ranges([key_range or (None, None)])
+
+	def mask_paths(self, abs_asset_path):
+		"""
+			Returns the paths of the per-mask entries of abs_asset_path
+			(see mask_path).
+		"""
+		key = self.key(abs_asset_path)
+		return self.paths_in_ranges([(
+			key + Cache.MASK_SEPARATOR,
+			key + chr(ord(Cache.MASK_SEPARATOR) + 1)
+		)])
+
+	def paths_outside(self, abs_folders):
+		"""
+			Returns the absolute paths of the files in the cache that
+			are not inside any of abs_folders.
+		"""
+		excluded = []
+		for abs_folder in abs_folders:
+			key_range = self.folder_range(abs_folder)
+			if key_range is None:
+				return []
+			excluded.append(key_range)
+		return self.paths_in_ranges(Cache.exclude_ranges(None, None, excluded))
+
+	def nested_paths(self, abs_folder, abs_skip_folders=()):
+		"""
+			Returns the absolute paths of the files in the cache inside
+			the subfolders of abs_folder, except those in abs_skip_folders.
+		"""
+		key_range = self.folder_range(abs_folder) or (None, None)
+		excluded = [
+			key_range for key_range in
+			(self.folder_range(folder) for folder in abs_skip_folders)
+			if key_range is not None
+		]
+		return self.paths_in_ranges(
+			Cache.exclude_ranges(key_range[0], key_range[1], excluded),
+			len(key_range[0] or "")
+		)
+
+	def child_names(self, abs_folder):
+		"""
+			Returns the names of the files in the cache directly
+			inside abs_folder.
+		"""
+		self.commit()
+		separator = "/" if self.source_root else os.sep
+		key_range = self.folder_range(abs_folder)
+		if key_range is None:
+			return [
+				row[0] for row in self.connection.execute(
+					"SELECT path FROM entries WHERE instr(path, ?) = 0",
+					(separator,)
+				)
+			]
+
+		# usually still held from building the folder
+		directory = key_range[0][:-1]
+		if directory == self.last_directory:
+			return self.last_entries.keys()
+		if directory in self.directories:
+			return self.directories[directory].keys()
+
+		offset = len(key_range[0])
+		return [
+			row[0][offset:] for row in self.connection.execute(
+				"SELECT path FROM entries WHERE path >= ? AND path < ? "
+				"AND instr(substr(path, ?), ?) = 0",
+				key_range + (offset + 1, separator)
+			)
+		]
+
+	def path(self, key):
+		if not self.source_root:
+			return key
+		return os.path.join(self.source_root, key.replace("/", os.sep))
+
+	def output_key(self, abs_output_path):
+		if not self.destination_root:
+			return abs_output_path
+		relative_path = Cache.relative_key(abs_output_path, self.destination_root)
+		if relative_path.startswith(os.pardir):
+			return abs_output_path
+		return relative_path
+
+	def output_path(self, output_key):
+		if not self.destination_root:
+			return output_key
+		return os.path.join(self.destination_root, output_key.replace("/", os.sep))
+
+	@staticmethod
+	def make_entry(stat, digest, recipe, entry=None):
+		"""
+			Returns a new entry for a file; the last build time and
+			outputs are kept from entry, if given.
+		"""
+		if entry is None:
+			entry = [None] * Cache.ENTRY_LENGTH
+		return [
+			stat.st_mtime,
+			stat.st_size,
+			stat.st_ino,
+			digest,
+			recipe,
+			entry[Cache.ENTRY_DURATION],
+			entry[Cache.ENTRY_OUTPUTS],
+			None
+		]
+
+	# Entries written before recipes were tracked adopt
+	# the current recipe rather than forcing a rebuild.
+	@staticmethod
+	def recipe_changed(entry, recipe):
+		return (
+			recipe is not None and
+			entry[Cache.ENTRY_RECIPE] is not None and
+			entry[Cache.ENTRY_RECIPE] != recipe
+		)
+
+	@staticmethod
+	def adopt_recipe(entry, recipe):
+		# returns the entry to store, if it changed
+		if recipe is not None and entry[Cache.ENTRY_RECIPE] is None:
+			entry[Cache.ENTRY_RECIPE] = recipe
+			return entry
+		return None
+
+	@staticmethod
+	def stat_matches(entry, stat):
+		return (
+			entry[Cache.ENTRY_MTIME] == stat.st_mtime and
+			entry[Cache.ENTRY_SIZE] == stat.st_size and
+			entry[Cache.ENTRY_INODE] == stat.st_ino
+		)
+
+	def remove(self):
+		for path in (
+			self.abs_cache_path,
+			self.abs_cache_path + "-wal",
+			self.abs_cache_path + "-shm",
+			self.abs_legacy_cache_path
+		):
+			if os.path.exists(path):
+				os.unlink(path)
+
+class OutputStore(object):
+	"""
+		A content addressed store of tool outputs, shared by every
+		build that uses it. Entries are keyed by the source file's
+		contents and the commands that converted it (see key), so
+		outputs can be restored, rather than rebuilt, after a branch
+		switch or a clean build.
+
+		The least recently used entries are evicted once the store
+		grows past max_size bytes.
+	"""
+	INDEX_NAME = "index.db"
+
+	def __init__(self, root, max_size, method="copy"):
+		self.root = os.path.abspath(root)
+		self.max_size = max_size
+
+		# how outputs are restored; see util.copy_file
+		self.method = method
+		self.connection = None
+		self.total_size = 0
+
+	def open(self):
+		make_dirs(os.path.join(self.root, "tmp"))
+		self.connection = sqlite3.connect(
+			os.path.join(self.root, OutputStore.INDEX_NAME)
+		)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute(
+			"CREATE TABLE IF NOT EXISTS entries ("
+			"key TEXT PRIMARY KEY, count INTEGER, size INTEGER, "
+			"last_used REAL)"
+		)
+		self.connection.commit()
+		self.total_size = self.connection.execute(
+			"SELECT COALESCE(SUM(size), 0) FROM entries"
+		).fetchone()[0]
+
+	def save(self):
+		self.connection.commit()
+
+	@staticmethod
+	def key(digest, recipe):
+		"""
+			Returns the store key for a source file with contents digest,
+			converted by commands with fingerprint recipe.
+		"""
+		return hashlib.sha1("%s\0%s" % (digest, recipe)).hexdigest()
+
+	def entry_path(self, key):
+		return os.path.join(self.root, key[:2], key)
+
+	def restore(self, key, outputs):
+		"""
+			Restore the outputs stored under key to the paths in outputs.
+			Returns True on success, or False if there was no entry.
+		"""
+		row = self.connection.execute(
+			"SELECT count FROM entries WHERE key = ?", (key,)
+		).fetchone()
+		if row is None or row[0] != len(outputs):
 			return False
 
+		entry_path = self.entry_path(key)
+		try:
+			for index, output in enumerate(outputs):
+				make_dirs(os.path.dirname(output))
+				copy_file(
+					os.path.join(entry_path, str(index)),
+					output,
+					self.method
+				)
+		except (IOError, OSError) as exc:
+			logging.warn("Discarding output store entry %s, %s" % (key, exc))
+			self.discard(key)
+			return False
+
+		self.connection.execute(
+			"UPDATE entries SET last_used = ? WHERE key = ?",
+			(time.time(), key)
+		)
 		return True
 
-	def remove(self):
-		if os.path.exists(self.abs_cache_path):
-			os.unlink(self.abs_cache_path)
+	def put(self, key, outputs):
+		"""
+			Add the outputs of a successful job to the store.
+			Returns False if they could not be stored.
+		"""
+		size = 0
+		for output in outputs:
+			try:
+				size += os.stat(output).st_size
+			except OSError:
+				return False
+
+		if size > self.max_size:
+			return False
+
+		# entries are written to a temporary folder first, so an
+		# interrupted build never leaves a partial entry behind.
+		temp_path = os.path.join(
+			self.root, "tmp", "%s.%i.%i" % (key, os.getpid(), id(outputs))
+		)
+		entry_path = self.entry_path(key)
+		try:
+			make_dirs(temp_path)
+			for index, output in enumerate(outputs):
+				copy_file(output, os.path.join(temp_path, str(index)))
+
+			if os.path.isdir(entry_path):
+				shutil.rmtree(entry_path)
+			make_dirs(os.path.dirname(entry_path))
+			os.rename(temp_path, entry_path)
+		except (IOError, OSError) as exc:
+			logging.warn("Unable to store outputs for %s, %s" % (outputs, exc))
+			shutil.rmtree(temp_path, ignore_errors=True)
+			return False
+
+		self.discard_row(key)
+		self.connection.execute(
+			"INSERT INTO entries VALUES (?, ?, ?, ?)",
+			(key, len(outputs), size, time.time())
+		)
+		self.total_size += size
+		self.evict()
+		return True
+
+	def evict(self):
+		while self.total_size > self.max_size:
+			rows = self.connection.execute(
+				"SELECT key FROM entries ORDER BY last_used LIMIT 64"
+			).fetchall()
+			if not rows:
+				break
+			for (key,) in rows:
+				self.discard(key)
+				if self.total_size <= self.max_size:
+					break
+
+	def discard(self, key):
+		self.discard_row(key)
+		shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+	def discard_row(self, key):
+		row = self.connection.execute(
+			"SELECT size FROM entries WHERE key = ?", (key,)
+		).fetchone()
+		if row is not None:
+			self.total_size -= row[0]
+			self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+class BufferedLog(object):
+	"""
+		Holds log messages produced by a job running on a worker
+		thread so they can be replayed, in order, on the main thread.
+	"""
+	def __init__(self):
+		self.records = []
+
+	def info(self, message):
+		self.records.append((logging.INFO, message))
+
+	def warn(self, message):
+		self.records.append((logging.WARNING, message))
+
+	def error(self, message):
+		self.records.append((logging.ERROR, message))
+
+	def flush(self):
+		for level, message in self.records:
+			logging.log(level, message)
+		self.records = []
+
+class WorkerPool(object):
+	"""
+		Runs jobs on a bounded number of worker threads.
+
+		Results are handed back in the order the jobs finish. With a
+		single worker, jobs are run inline on the calling thread.
+
+		budget maps resource names (such as "memory" and "cpu") to the
+		amount the machine can spare. A job submitted with a cost only
+		starts while the running jobs leave enough of each resource,
+		and a job with a group and limit only starts while fewer than
+		limit jobs of that group are running. Waiting jobs are started
+		in submission order, skipping any that don't fit yet.
+
+		Each group waits in its own queue. Submitting blocks while the
+		jobs that could start right away fill the queues, so jobs held
+		back by their group's limit or the budget don't keep other
+		jobs from reaching idle workers.
+	"""
+	def __init__(self, num_workers, budget=None):
+		self.num_workers = max(1, num_workers)
+		self.budget = budget or {}
+		self.queues = {}
+		self.limits = {}
+
+		# index -> result of finished jobs, in the order they finished
+		self.results = collections.OrderedDict()
+		self.condition = threading.Condition()
+		self.submitted = 0
+		self.collected = 0
+		self.stopping = False
+		self.threads = []
+
+		# resources and group slots held by running jobs
+		self.running = 0
+		self.in_use = dict.fromkeys(self.budget, 0)
+		self.group_running = {}
+
+		# group: [jobs, seconds spent waiting to start, longest wait]
+		self.queue_times = {}
+
+		if self.num_workers > 1:
+			for index in range(self.num_workers):
+				thread = threading.Thread(target=self.worker)
+				thread.daemon = True
+				thread.start()
+				self.threads.append(thread)
+
+	def run(self, function, args):
+		try:
+			return (True, function(*args))
+		except:
+			return (False, sys.exc_info())
+
+	def fits(self, group, limit, cost):
+		if limit and self.group_running.get(group, 0) >= limit:
+			return False
+
+		# a job that needs more than the whole budget runs on its own
+		if not self.running:
+			return True
+
+		for name, amount in cost.iteritems():
+			if name in self.budget and self.in_use[name] + amount > self.budget[name]:
+				return False
+		return True
+
+	def acquire(self, group, cost, queued):
+		self.running += 1
+		self.group_running[group] = self.group_running.get(group, 0) + 1
+		for name, amount in cost.iteritems():
+			if name in self.in_use:
+				self.in_use[name] += amount
+
+		wait = time.time() - queued
+		times = self.queue_times.setdefault(group, [0, 0.0, 0.0])
+		times[0] += 1
+		times[1] += wait
+		times[2] = max(times[2], wait)
+
+	def release(self, group, cost):
+		self.running -= 1
+		self.group_running[group] -= 1
+		for name, amount in cost.iteritems():
+			if name in self.in_use:
+				self.in_use[name] -= amount
+
+	def ready(self):
+		"""
+			Returns how many waiting jobs could start right away, given
+			their group's limit and the budget left.
+		"""
+		count = 0
+		for group, queue in self.queues.iteritems():
+			if not queue:
+				continue
+			slots = len(queue)
+			limit = self.limits[group]
+			if limit:
+				slots = min(slots, limit - self.group_running.get(group, 0))
+
+			# jobs of a group share their tool's cost
+			cost = queue[0][5]
+			if self.running:
+				for name, amount in cost.iteritems():
+					if amount > 0 and name in self.budget:
+						slots = min(slots, int(
+							(self.budget[name] - self.in_use[name]) / amount
+						))
+			count += max(0, slots)
+		return count
+
+	def next_task(self):
+		best = None
+		for group, queue in self.queues.iteritems():
+			if not queue:
+				continue
+			task = queue[0]
+			if best is not None and task[0] > best[0]:
+				continue
+			if self.fits(group, self.limits[group], task[5]):
+				best = task
+
+		if best is not None:
+			index, function, args, group, limit, cost, queued = best
+			self.queues[group].popleft()
+			self.acquire(group, cost, queued)
+		return best
+
+	def worker(self):
+		while True:
+			with self.condition:
+				task = self.next_task()
+				while task is None:
+					if self.stopping and not any(self.queues.itervalues()):
+						return
+					self.condition.wait()
+					task = self.next_task()
+				# room for another job to be submitted
+				self.condition.notify_all()
+
+			index, function, args, group, limit, cost, queued = task
+			result = self.run(function, args)
+			with self.condition:
+				self.release(group, cost)
+				self.results[index] = result
+				self.condition.notify_all()
+
+	def submit(self, function, *args):
+		"""
+			Queue function(*args) for execution and return the job index.
+			Blocks while all workers are busy and the queue is full.
+		"""
+		return self.submit_limited(None, 0, {}, function, *args)
+
+	def submit_limited(self, group, limit, cost, function, *args):
+		"""
+			Like submit, but the job holds cost (a dict of resource
+			amounts) out of the budget while it runs, and no more than
+			limit jobs of group run at once (0 for no limit).
+		"""
+		index = self.submitted
+		self.submitted += 1
+		task = (index, function, args, group, limit, cost, time.time())
+
+		if self.threads:
+			with self.condition:
+				while self.ready() >= self.num_workers * 2:
+					# use a timeout so KeyboardInterrupt is delivered
+					self.condition.wait(0.1)
+				self.limits[group] = limit
+				self.queues.setdefault(group, collections.deque()).append(task)
+				self.condition.notify_all()
+		else:
+			self.acquire(group, cost, task[-1])
+			self.results[index] = self.run(function, args)
+			self.release(group, cost)
+		return index
+
+	def completed(self, block=False):
+		"""
+			Yield (index, result) for finished jobs in the order they
+			finished. If block is True, wait until every submitted job
+			is done. Exceptions raised by a job are re-raised here.
+		"""
+		while self.collected < self.submitted:
+			with self.condition:
+				while not self.results:
+					if not block:
+						return
+					# use a timeout so KeyboardInterrupt is delivered
+					self.condition.wait(0.1)
+				index, (succeeded, value) = self.results.popitem(last=False)
+
+			self.collected += 1
+			if not succeeded:
+				raise value[0], value[1], value[2]
+			yield index, value
+
+	def join(self, cancel=False):
+		"""
+			Wait for the workers to finish. With cancel set, jobs that
+			have not started yet are dropped rather than run.
+		"""
+		with self.condition:
+			if cancel:
+				dropped = sum(len(queue) for queue in self.queues.itervalues())
+				self.queues.clear()
+				self.submitted -= dropped
+			self.stopping = True
+			self.condition.notify_all()
+		for thread in self.threads:
+			thread.join()
+		self.threads = []
+
+class Pipeline(object):
+	"""
+		The steps of a pipeline tool, resolved for one file.
+
+		The chains run at the same time. Each chain is a list of stages
+		run one after another, passing data through temporary files in
+		folder. Each stage is a list of (tool, command) pairs, where each
+		command's standard output is piped to the next command's standard
+		input.
+	"""
+	def __init__(self, chains, folder):
+		self.chains = chains
+		self.folder = folder
+
+	def __str__(self):
+		text = " & ".join(
+			" && ".join(
+				" | ".join(
+					" ".join(command) if type(command) is tuple else command
+					for tool, command in stage
+				)
+				for stage in chain
+			)
+			for chain in self.chains
+		)
+		# the folder differs per run; leave it out of fingerprints
+		return text.replace(self.folder, "${temp_folder}")
+
+class WorkQueue(object):
+	"""
+		A thread-safe queue of pending work items. Consumers are woken
+		as soon as an item arrives; an item that is already pending is
+		not queued twice.
+	"""
+	# by default, items are collected for at most this many
+	# settle periods after the first one arrived.
+	SETTLE_LIMIT = 20
+
+	def __init__(self):
+		self.items = []
+		self.pending = set()
+		self.first_time = None
+		self.condition = threading.Condition()
+
+	def put(self, item):
+		with self.condition:
+			if item not in self.pending:
+				if not self.items:
+					self.first_time = time.time()
+				self.pending.add(item)
+				self.items.append(item)
+				self.condition.notify_all()
+
+	def get_all(self, timeout=None, settle=0.0, limit=None):
+		"""
+			Wait up to timeout seconds for work and return every pending
+			item. Once the first item arrives, keep collecting until no new
+			items have arrived for settle seconds, so a burst of events
+			(or a file that is still being written) is handled together.
+			Collection stops limit seconds after the first item arrived
+			(settle * SETTLE_LIMIT by default), so a steady stream of
+			items is still handed out.
+		"""
+		if limit is None:
+			limit = settle * WorkQueue.SETTLE_LIMIT
+
+		with self.condition:
+			if not self.items:
+				self.condition.wait(timeout)
+
+			count = len(self.items)
+			while count and settle > 0:
+				remaining = self.first_time + limit - time.time()
+				if remaining <= 0:
+					break
+				self.condition.wait(min(settle, remaining))
+				if len(self.items) == count:
+					break
+				count = len(self.items)
+
+			items = self.items
+			self.items = []
+			self.pending = set()
+		return items
+
+class ReloadNotifier(object):
+	"""
+		Tells a running game which resources were modified.
+
+		Requests are sent from background threads, each holding a
+		kept-alive connection to the server. Resources queued within
+		window seconds of the first unsent one go out in a single request:
+
+			{"type": "file_modified", "resource": "sounds/a.ogg"}
+			{"type": "file_modified", "resources": ["a.ogg", "b.ogg"]}
+	"""
+	def __init__(self, url, window=0.05, max_batch=256, connections=1):
+		parts = urlparse.urlsplit(url)
+		if parts.scheme != "http":
+			raise Exception("Unsupported reload url \"%s\"" % url)
+
+		self.host = parts.hostname
+		self.port = parts.port or 80
+		self.uri = parts.path or "/"
+		self.window = window
+		self.max_batch = max_batch
+		self.queue = WorkQueue()
+		self.stopped = False
+
+		self.threads = []
+		for index in range(max(1, connections)):
+			thread = threading.Thread(target=self.sender)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def notify(self, resource):
+		self.queue.put(resource)
+
+	def sender(self):
+		connection = None
+		while True:
+			# the window starts with the first queued resource, so
+			# a steady stream of conversions doesn't delay reloads.
+			resources = self.queue.get_all(1.0, self.window, self.window)
+			if not resources:
+				if self.stopped:
+					break
+				continue
+
+			for index in range(0, len(resources), self.max_batch):
+				connection = self.send(
+					connection,
+					resources[index:index + self.max_batch]
+				)
+
+		if connection:
+			connection.close()
+
+	def send(self, connection, resources):
+		if len(resources) == 1:
+			request_packet = {
+				"type": "file_modified",
+				"resource": resources[0]
+			}
+		else:
+			request_packet = {
+				"type": "file_modified",
+				"resources": resources
+			}
+		body = json.dumps(request_packet)
+
+		# a kept-alive connection may have been closed by the
+		# server since the last request, so retry once on a new one.
+		for attempt in range(2):
+			if connection is None:
+				connection = httplib.HTTPConnection(self.host, self.port)
+			try:
+				connection.request("PUT", self.uri, body)
+				response = connection.getresponse()
+				response.read()
+				if response.status != 204 and response.status != 200:
+					logging.warn("Request failed: (%i) %s" % (response.status, response.reason))
+				return connection
+			except (socket.error, httplib.HTTPException):
+				connection.close()
+				connection = None
+		return connection
+
+	def stop(self):
+		"""
+			Send anything still queued, then stop the sender threads.
+		"""
+		self.stopped = True
+		for thread in self.threads:
+			thread.join()
+
+class PollingWatcher(object):
+	"""
+		A fallback for watchdog that polls the asset source folders.
+
+		It keeps a snapshot of (mtime, size) for each entry in the
+		folders and scans them round-robin, one folder at a time. A full
+		sweep takes interval seconds, or longer on trees of more than
+		rate entries per second, so the CPU used stays bounded however
+		large the tree is. Only the asset folders and the folders matched
+		by a mask (such as .app bundles), with everything inside them,
+		are watched, as masks do not look any deeper.
+
+		This mirrors the parts of watchdog's Observer that monitor_assets
+		uses and calls the same on_created/on_modified/on_deleted methods.
+	"""
+	# entries checked per second on large trees
+	RATE = 10000
+
+	def __init__(self, asset_folders, interval=1.0, rate=None):
+		self.masks = {}
+		for asset in asset_folders:
+			self.masks.setdefault(asset.abs_src_folder, []).append(asset)
+		self.folders = sorted(self.masks)
+		self.interval = interval
+		self.rate = rate or PollingWatcher.RATE
+
+		# folder -> {name: (mtime, size, is_dir)}, for the asset
+		# folders and every folder inside a matched folder.
+		self.snapshots = {}
+		self.handler = None
+		self.stopped = threading.Event()
+		self.thread = None
+
+	def schedule(self, handler, path, recursive=True):
+		self.handler = handler
+
+	def start(self):
+		for folder in self.folders:
+			self.poll(folder, dispatch=False)
+
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		self.stopped.set()
+
+	def join(self):
+		if self.thread:
+			self.thread.join()
+
+	def snapshot(self, folder):
+		snapshot = {}
+		try:
+			entries = list_directory(folder)
+		except OSError:
+			return snapshot
+
+		for name, is_dir, get_stat in entries:
+			try:
+				stat = get_stat()
+			except OSError:
+				# removed since the directory was listed
+				continue
+			snapshot[name] = (stat.st_mtime, stat.st_size, is_dir)
+		return snapshot
+
+	def watches(self, folder, name):
+		"""
+			Returns True if the subfolder name of folder is polled too.
+		"""
+		masks = self.masks.get(folder)
+		if masks is None:
+			# inside a matched folder
+			return True
+		return any(asset.match(name) for asset in masks)
+
+	def poll(self, folder, dispatch=True):
+		"""
+			Rescan folder, report what changed and start or stop
+			polling its subfolders. Returns the number of entries.
+		"""
+		old_snapshot = self.snapshots.get(folder, {})
+		new_snapshot = self.snapshot(folder)
+		self.snapshots[folder] = new_snapshot
+		if dispatch:
+			self.dispatch(folder, old_snapshot, new_snapshot)
+
+		for name, (mtime, size, is_dir) in old_snapshot.iteritems():
+			if is_dir and not new_snapshot.get(name, (0, 0, False))[2]:
+				self.forget(os.path.join(folder, name))
+
+		for name, (mtime, size, is_dir) in new_snapshot.iteritems():
+			path = os.path.join(folder, name)
+			if is_dir and path not in self.snapshots and self.watches(folder, name):
+				self.poll(path, dispatch)
+		return len(new_snapshot)
+
+	def forget(self, removed_folder):
+		prefix = os.path.join(removed_folder, "")
+		for folder in self.snapshots.keys():
+			if folder in self.masks:
+				continue
+			if folder == removed_folder or folder.startswith(prefix):
+				del self.snapshots[folder]
+
+	def run(self):
+		while not self.stopped.is_set():
+			total_entries = max(1, sum(
+				len(snapshot) for snapshot in self.snapshots.itervalues()
+			))
+			sweep_seconds = max(
+				self.interval, float(total_entries) / self.rate
+			)
+
+			for folder in sorted(self.snapshots):
+				if self.stopped.is_set():
+					break
+				if folder not in self.snapshots:
+					# removed earlier in this sweep
+					continue
+
+				count = self.poll(folder)
+				share = float(max(1, count)) / total_entries
+				self.stopped.wait(sweep_seconds * min(1.0, share))
+
+	def dispatch(self, folder, old_snapshot, new_snapshot):
+		for name, signature in new_snapshot.iteritems():
+			event = AttributeStore(src_path=os.path.join(folder, name))
+			if name not in old_snapshot:
+				self.handler.on_created(event)
+			elif old_snapshot[name] != signature:
+				self.handler.on_modified(event)
+
+		for name in old_snapshot:
+			if name not in new_snapshot:
+				event = AttributeStore(src_path=os.path.join(folder, name))
+				self.handler.on_deleted(event)
+
+class BuildTrace(object):
+	"""
+		Records the wall time, child CPU time and peak memory of every
+		command run during a build. The results can be logged as a
+		summary per tool and asset mask, or written as a Chrome trace
+		(chrome://tracing, ui.perfetto.dev).
+	"""
+	def __init__(self):
+		self.start = time.time()
+		self.events = []
+		self.threads = {}
+		self.lock = threading.Lock()
+
+	def record(self, tool, asset, target_path, command, start, wall, usage):
+		if usage is not None:
+			cpu = usage.ru_utime + usage.ru_stime
+			max_rss = usage.ru_maxrss
+			if get_platform() == "macosx":
+				# macOS reports bytes rather than kilobytes
+				max_rss /= 1024
+		else:
+			cpu = None
+			max_rss = None
+
+		if type(command) is tuple:
+			command = " ".join(command)
+
+		with self.lock:
+			thread_id = self.threads.setdefault(
+				threading.current_thread().ident, len(self.threads) + 1
+			)
+			self.events.append({
+				"tool": tool.name,
+				"mask": "%s/%s" % (asset.src_folder, asset.glob),
+				"path": target_path,
+				"command": command,
+				"start": start - self.start,
+				"wall": wall,
+				"cpu": cpu,
+				"max_rss": max_rss,
+				"thread": thread_id
+			})
+
+	def totals(self, key):
+		totals = {}
+		for event in self.events:
+			total = totals.setdefault(event[key], {
+				"runs": 0, "wall": 0.0, "cpu": 0.0, "max_rss": 0
+			})
+			total["runs"] += 1
+			total["wall"] += event["wall"]
+			total["cpu"] += event["cpu"] or 0.0
+			total["max_rss"] = max(total["max_rss"], event["max_rss"] or 0)
+		return totals
+
+	def log_summary(self):
+		for key, title in (("tool", "Tool"), ("mask", "Asset")):
+			totals = self.totals(key)
+			logging.info(
+				"%-32s %8s %10s %10s %12s" %
+				(title, "Runs", "Wall (s)", "CPU (s)", "Peak RSS (KB)")
+			)
+			for name, total in sorted(
+				totals.iteritems(), key=lambda item: -item[1]["wall"]
+			):
+				logging.info(
+					"%-32s %8i %10.3f %10.3f %12i" % (
+						name,
+						total["runs"],
+						total["wall"],
+						total["cpu"],
+						total["max_rss"]
+					)
+				)
+
+	def write_chrome_trace(self, path):
+		trace_events = []
+		for event in self.events:
+			trace_events.append({
+				"name": os.path.basename(event["path"]),
+				"cat": event["tool"],
+				"ph": "X",
+				"ts": int(event["start"] * 1000000),
+				"dur": int(event["wall"] * 1000000),
+				"pid": 1,
+				"tid": event["thread"],
+				"args": {
+					"mask": event["mask"],
+					"command": event["command"],
+					"cpu": event["cpu"],
+					"max_rss": event["max_rss"]
+				}
+			})
+
+		logging.info("Writing trace %s..." % path)
+		with open(path, "wb") as file:
+			json.dump({
+				"traceEvents": trace_events,
+				"displayTimeUnit": "ms"
+			}, file)
 
 class KeyValueCache(object):
 	def __init__(self):
@@ -238,6 +1957,33 @@ class Tool(object):
 	
 		self.output = data.get("output", "")
 
+		# built-in tools run inside blacksmith instead of
+		# launching one of the commands above.
+		self.builtin = data.get("builtin", None)
+
+		# batch tools accept up to this many files per invocation
+		self.batch_size = data.get("batch", 0)
+		if self.builtin:
+			self.batch_size = 0
+
+		# how many invocations may run at once (0 for no limit), and
+		# roughly what each one uses: "memory" in megabytes and "cpu"
+		# in cores. Jobs are packed against the machine's budget.
+		self.max_jobs = data.get("max_jobs", 0)
+		self.cost = {
+			"memory": data.get("memory", 0),
+			"cpu": data.get("cpu", 0)
+		}
+
+		# pipeline tools stream data between their steps. A step's
+		# tool says whether it can read %(step_input)s from standard
+		# input and write %(step_output)s to standard output, and the
+		# extension of the temporary file used when it can't.
+		self.pipeline = data.get("pipeline", False)
+		self.stdin = data.get("stdin", False)
+		self.stdout = data.get("stdout", False)
+		self.temp_extension = data.get("temp_extension", "")
+
 	def __str__(self):
 		return "Tool [Name=%s, Commands=%i]" % (self.name, len(self.commands))
 
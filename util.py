@@ -2,10 +2,32 @@ import os
 import re
 import copy
 import json
+import hashlib
+import pipes
 import shlex
+import errno
+import shutil
 import logging
 import platform
+import functools
 import subprocess
+import tempfile
+import threading
+import time
+
+try:
+	from os import scandir
+except ImportError:
+	try:
+		# optional backport for Python 2
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
 
 def clean_path(path):
 	return strip_trailing_slash(path)
@@ -17,8 +39,8 @@ def recursive_update(root, params):
 		elif type(value) is dict:
 			recursive_update(value, params)
 
-def execute_commands(
-	tools, 
+def resolve_commands(
+	tools,
 	current_tool,
 	paths,
 	asset,
@@ -26,44 +48,72 @@ def execute_commands(
 	platform_name,
 	param_overrides = {}
 	):
-	lines = []
-
+	"""
+		Expand current_tool's command templates for target_path.
 
-	#logging.info(current_tool.name)
-	outputs = []
-	for raw_command in current_tool.commands[platform_name]:
-		params = generate_params_for_file(
-			paths, 
+		Returns a list of (tool, command, output) tuples in execution
+		order, where tool is the tool the command comes from. Commands
+		from nested tools are included with an output of None. A pipeline
+		tool resolves to a single Pipeline command.
+	"""
+	if current_tool.batch_size:
+		return resolve_batch_commands(
+			tools,
+			current_tool,
+			paths,
 			asset,
-			target_path,
-			platform_name
+			[target_path],
+			platform_name,
+			param_overrides
+		)
+
+	commands = []
+	params = expand_params(
+		compile_params(paths, asset, platform_name, param_overrides),
+		paths,
+		asset,
+		target_path
+	)
+
+	if current_tool.builtin:
+		# built-in commands are tuples of (name, source, destination, method)
+		cmd = (
+			current_tool.builtin,
+			params["src_file_path"],
+			params["dst_file_path"],
+			params.get("copy_method", "copy")
 		)
+		commands.append((current_tool, cmd, current_tool.output % params))
+		return commands
 
-		params.update(param_overrides)
-		recursive_update(params, params)
+	if current_tool.pipeline:
+		commands.append((
+			current_tool,
+			resolve_pipeline(
+				tools,
+				current_tool,
+				paths,
+				asset,
+				target_path,
+				platform_name,
+				param_overrides
+			),
+			current_tool.output % params
+		))
+		return commands
 
+	for raw_command in current_tool.commands[platform_name]:
 		if type_is_string(raw_command):		
 			try:
 				cmd = (raw_command % params).encode("ascii")
-				lines.append(cmd)
 			except TypeError as exc:
-				logging.error(raw_cmd)
-				logging.error(params)			
+				logging.error(raw_command)
+				logging.error(params)
+				raise
 
-			# we need this to pass to shlex, otherwise it could screw up
-			# paths on non-posix compliant systems.
-			use_posix_paths = (get_platform() is not "windows")
-			runnable = shlex.split(cmd, posix=use_posix_paths)
-			try:
-				returncode = subprocess.call(runnable, shell=run_as_shell())
-				if returncode != 0:
-					logging.error("ERROR %s" % cmd)
-			except OSError as exc:
-				logging.error("ERROR executing \"%s\", %s" % (cmd, exc))
-			
 			# record the output as the absolute destination path
-			outputs.append(current_tool.output % params)
-			
+			commands.append((current_tool, cmd, current_tool.output % params))
+
 		elif type(raw_command) is dict:
 			if not "tool" in raw_command:
 				raise Exception("Missing tool from command block! (%s)",
@@ -77,7 +127,7 @@ def execute_commands(
 			sub_overrides = {}
 			if "params" in raw_command:
 				sub_overrides = raw_command["params"]
-			execute_commands(
+			for tool, cmd, output in resolve_commands(
 				tools,
 				subtool,
 				paths,
@@ -85,53 +135,773 @@ def execute_commands(
 				target_path,
 				platform_name,
 				sub_overrides
+			):
+				commands.append((tool, cmd, None))
+
+	return commands
+
+def pipeline_steps(tools, current_tool, platform_name, param_overrides = {}):
+	"""
+		Flatten the commands of a pipeline tool, and of the tools nested
+		in it, into a list of (tool, command template, overrides) steps.
+		Built-in tools are a step with no template.
+	"""
+	if current_tool.builtin:
+		return [(current_tool, None, param_overrides)]
+
+	steps = []
+	for raw_command in current_tool.commands[platform_name]:
+		if type_is_string(raw_command):
+			steps.append((current_tool, raw_command, param_overrides))
+
+		elif type(raw_command) is dict:
+			if not "tool" in raw_command:
+				raise Exception("Missing tool from command block! (%s)",
+					current_tool.name
+				)
+
+			steps.extend(pipeline_steps(
+				tools,
+				tools[raw_command["tool"]],
+				platform_name,
+				raw_command.get("params", {})
+			))
+	return steps
+
+def resolve_pipeline(
+	tools,
+	current_tool,
+	paths,
+	asset,
+	target_path,
+	platform_name,
+	param_overrides = {}
+	):
+	"""
+		Resolve the steps of a pipeline tool for target_path.
+
+		A step whose command uses %(step_input)s reads what the step
+		before it wrote to %(step_output)s. If the earlier step's tool
+		can write to standard output and the later step's tool can read
+		standard input, both parameters are "-" and the commands are
+		connected by a pipe. Otherwise the data goes through a temporary
+		file under get_temp_root(). A step that doesn't use
+		%(step_input)s reads the source file and starts a new chain,
+		which runs alongside the others.
+
+		Returns a Pipeline.
+	"""
+	from models import Pipeline
+
+	steps = pipeline_steps(tools, current_tool, platform_name, param_overrides)
+	folder = os.path.join(
+		get_temp_root(),
+		"blacksmith-%i-%s" % (os.getpid(), hashlib.sha1(target_path.encode("utf-8")).hexdigest())
+	)
+
+	# how each step gets its input: "pipe", "file" or None
+	# when it starts a new chain.
+	links = []
+	for index, (tool, raw_command, overrides) in enumerate(steps):
+		link = None
+		if index and raw_command and "%(step_input)" in raw_command:
+			previous_tool, previous_command, previous_overrides = steps[index - 1]
+			if previous_command is None:
+				link = None
+			elif previous_tool.stdout and tool.stdin:
+				link = "pipe"
+			else:
+				link = "file"
+		links.append(link)
+	links.append(None)
+
+	chains = []
+	temp_path = None
+	for index, (tool, raw_command, overrides) in enumerate(steps):
+		params = expand_params(
+			compile_params(paths, asset, platform_name, overrides),
+			paths,
+			asset,
+			target_path
+		)
+
+		if links[index] is None:
+			chains.append([[]])
+			params["step_input"] = params["src_file_path"]
+		elif links[index] == "file":
+			chains[-1].append([])
+			params["step_input"] = temp_path
+		else:
+			params["step_input"] = "-"
+
+		if links[index + 1] == "pipe":
+			params["step_output"] = "-"
+		elif links[index + 1] == "file":
+			extension = ""
+			if tool.temp_extension:
+				extension = ".%s" % tool.temp_extension
+			temp_path = os.path.join(folder, "%i%s" % (index, extension))
+			params["step_output"] = temp_path
+		else:
+			params["step_output"] = tool.output % params
+
+		if raw_command is None:
+			cmd = (
+				tool.builtin,
+				params["src_file_path"],
+				params["dst_file_path"],
+				params.get("copy_method", "copy")
 			)
+		else:
+			try:
+				cmd = (raw_command % params).encode("ascii")
+			except TypeError as exc:
+				logging.error(raw_command)
+				logging.error(params)
+				raise
+		chains[-1][-1].append((tool, cmd))
+
+	return Pipeline(chains, folder)
+
+# parameters that differ for each file; batch tools also
+# receive them as space separated lists.
+FILE_PARAMS = [
+	"src_file_relpath",
+	"src_file_path",
+	"src_file_basename",
+	"src_file_ext",
+	"dst_file_path",
+	"dst_file_noext"
+]
+BATCH_PARAMS = FILE_PARAMS
+
+def resolve_batch_commands(
+	tools,
+	current_tool,
+	paths,
+	asset,
+	target_paths,
+	platform_name,
+	param_overrides = {}
+	):
+	"""
+		Expand a batch tool's command templates once for all of
+		target_paths. Each parameter in BATCH_PARAMS is also available
+		with a _list suffix, holding the quoted values for every file.
+
+		Returns a list of (tool, command, outputs) tuples, where outputs
+		lists the output of every file in the batch. Nested tools are
+		expanded per file.
+	"""
+	compiled = compile_params(paths, asset, platform_name, param_overrides)
+	file_params = [
+		expand_params(compiled, paths, asset, target_path)
+		for target_path in target_paths
+	]
+
+	params = copy.copy(file_params[0])
+	for key in BATCH_PARAMS:
+		params["%s_list" % key] = " ".join(
+			pipes.quote(item[key]) for item in file_params
+		)
+	outputs = [current_tool.output % item for item in file_params]
+
+	commands = []
+	for raw_command in current_tool.commands[platform_name]:
+		if type_is_string(raw_command):
+			try:
+				cmd = (raw_command % params).encode("ascii")
+			except TypeError as exc:
+				logging.error(raw_command)
+				logging.error(params)
+				raise
+			commands.append((current_tool, cmd, outputs))
+
+		elif type(raw_command) is dict:
+			if not "tool" in raw_command:
+				raise Exception("Missing tool from command block! (%s)",
+					current_tool.name
+				)
+
+			subtool = tools[raw_command["tool"]]
+			sub_overrides = {}
+			if "params" in raw_command:
+				sub_overrides = raw_command["params"]
+			for target_path in target_paths:
+				for tool, cmd, output in resolve_commands(
+					tools,
+					subtool,
+					paths,
+					asset,
+					target_path,
+					platform_name,
+					sub_overrides
+				):
+					commands.append((tool, cmd, None))
+
+	return commands
 
+def list_outputs(commands):
+	"""
+		Returns the distinct outputs of commands, in order. Tools
+		without an "output" template have no outputs.
+	"""
+	outputs = []
+	for tool, cmd, output in commands:
+		if not output:
+			continue
+		if type(output) is not list:
+			output = [output]
+		for item in output:
+			if item and item not in outputs:
+				outputs.append(item)
 	return outputs
 
+def split_outputs(outputs, count):
+	"""
+		Split the outputs execute_commands returned for a job of count
+		files into the distinct outputs of each file. Batch commands
+		list their outputs in file order, one command after another.
+	"""
+	return [
+		list_outputs([(None, None, outputs[index::count])])
+		for index in range(count)
+	]
+
+def hash_commands(tool, platform_name, commands, paths=None):
+	"""
+		Fingerprint the resolved commands for a file, so a change to the
+		tool, its parameters or the platform can be detected.
+
+		If paths is given, the source and destination roots are left out
+		so the fingerprint is the same wherever the tree is checked out.
+	"""
+	roots = []
+	if paths is not None:
+		roots = sorted([
+			(paths.source_root, "${source_root}"),
+			(paths.destination_root, "${destination_root}")
+		], key=lambda root: -len(root[0]))
+
+	digest = hashlib.sha1()
+	digest.update("%s\0%s\0" % (tool.name, platform_name))
+	for command_tool, cmd, output in commands:
+		text = "%s\0%s\0" % (cmd, output)
+		for root, name in roots:
+			text = text.replace(root, name)
+		digest.update(text)
+	return digest.hexdigest()
+
+def execute_commands(
+	tools, 
+	current_tool,
+	paths,
+	asset,
+	target_path,
+	platform_name,
+	param_overrides = {},
+	log = logging,
+	commands = None,
+	trace = None
+	):
+	if commands is None:
+		commands = resolve_commands(
+			tools,
+			current_tool,
+			paths,
+			asset,
+			target_path,
+			platform_name,
+			param_overrides
+		)
+
+	from models import Pipeline, ToolFailedException
+
+	def record(tool, cmd, start, wall, usage):
+		trace.record(tool, asset, target_path, cmd, start, wall, usage)
+
+	# most tools write their outputs in place
+	unlink_linked_files(list_outputs(commands))
+
+	#logging.info(current_tool.name)
+	outputs = []
+	for tool, cmd, output in commands:
+		start = time.time()
+		usage = None
+		failure = None
+
+		if isinstance(cmd, Pipeline):
+			# each of its commands is traced separately
+			failure = run_pipeline(cmd, log, record if trace else None)
+		elif type(cmd) is tuple:
+			try:
+				run_builtin(*cmd)
+			except (IOError, OSError) as exc:
+				failure = "ERROR executing \"%s\", %s" % (" ".join(cmd), exc)
+		else:
+			# we need this to pass to shlex, otherwise it could screw up
+			# paths on non-posix compliant systems.
+			use_posix_paths = (get_platform() is not "windows")
+			runnable = shlex.split(cmd, posix=use_posix_paths)
+			try:
+				returncode, usage = call_command(runnable, log)
+				if returncode != 0:
+					failure = "ERROR %s" % cmd
+			except OSError as exc:
+				failure = "ERROR executing \"%s\", %s" % (cmd, exc)
+
+		if trace and not isinstance(cmd, Pipeline):
+			record(tool, cmd, start, time.time() - start, usage)
+
+		# later commands usually depend on earlier ones
+		if failure:
+			log.error(failure)
+			raise ToolFailedException(failure)
+
+		# batch commands record the output of every file; tools
+		# without an "output" template have none.
+		if type(output) is list:
+			outputs.extend(item for item in output if item)
+		elif output:
+			outputs.append(output)
+
+	return outputs
+
+def call_command(runnable, log = logging):
+	"""
+		Run a command and return (returncode, usage), where usage is the
+		child's resource usage from os.wait4, or None where that is not
+		available.
+	"""
+	# When logging directly, the tool shares our stdout/stderr.
+	# Otherwise the output is captured so it can be replayed
+	# along with the rest of the job's log.
+	capture = log is not logging
+	process = subprocess.Popen(
+		runnable,
+		shell=run_as_shell(),
+		stdout=subprocess.PIPE if capture else None,
+		stderr=subprocess.STDOUT if capture else None
+	)
+
+	if capture:
+		output = process.stdout.read()
+		process.stdout.close()
+		if output:
+			log.info(output.rstrip())
+
+	return wait_process(process)
+
+def wait_process(process):
+	"""
+		Wait for process to exit and return (returncode, usage), as
+		call_command does.
+	"""
+	if not hasattr(os, "wait4"):
+		return process.wait(), None
+
+	while True:
+		try:
+			pid, status, usage = os.wait4(process.pid, 0)
+			break
+		except OSError as exc:
+			if exc.errno != errno.EINTR:
+				raise
+
+	if os.WIFSIGNALED(status):
+		process.returncode = -os.WTERMSIG(status)
+	else:
+		process.returncode = os.WEXITSTATUS(status)
+	return process.returncode, usage
+
+def run_pipeline(pipeline, log = logging, record = None):
+	"""
+		Run the chains of a Pipeline at the same time, and the stages
+		of each chain one after another. Temporary files are removed
+		once every chain has finished.
+
+		Returns the error message of the first stage that failed, or
+		None. If given, record(tool, command, start, wall, usage) is
+		called for every command that ran.
+	"""
+	make_dirs(pipeline.folder)
+	failures = []
+
+	def run_chain(chain):
+		for stage in chain:
+			failure = run_stage(stage, log, record)
+			if failure:
+				failures.append(failure)
+				return
+
+	threads = []
+	for chain in pipeline.chains[1:]:
+		thread = threading.Thread(target=run_chain, args=(chain,))
+		thread.start()
+		threads.append(thread)
+
+	try:
+		run_chain(pipeline.chains[0])
+	finally:
+		for thread in threads:
+			thread.join()
+		shutil.rmtree(pipeline.folder, ignore_errors=True)
+
+	if failures:
+		return failures[0]
+	return None
+
+def run_stage(stage, log = logging, record = None):
+	"""
+		Run one stage of a Pipeline: its commands are started together,
+		each one's standard output piped to the next one's standard input.
+		Returns an error message if any of them failed, otherwise None.
+	"""
+	start = time.time()
+	tool, cmd = stage[0]
+	if type(cmd) is tuple:
+		# built-in tools run on their own
+		failure = None
+		try:
+			run_builtin(*cmd)
+		except (IOError, OSError) as exc:
+			failure = "ERROR executing \"%s\", %s" % (" ".join(cmd), exc)
+		if record:
+			record(tool, cmd, start, time.time() - start, None)
+		return failure
+
+	# as in call_command, output is captured when logging to a
+	# buffer. The pipes carry data, so only the last command's
+	# standard output and every command's errors are logged.
+	capture = log is not logging
+	output = None
+	if capture:
+		output = tempfile.TemporaryFile()
+
+	use_posix_paths = (get_platform() is not "windows")
+	failure = None
+	processes = []
+	stdin = None
+	try:
+		for position, (tool, cmd) in enumerate(stage):
+			last = position == len(stage) - 1
+			try:
+				process = subprocess.Popen(
+					shlex.split(cmd, posix=use_posix_paths),
+					shell=run_as_shell(),
+					stdin=stdin,
+					stdout=output if last else subprocess.PIPE,
+					stderr=output,
+					# other pipes must not keep a reader waiting for EOF
+					close_fds=(os.name != "nt")
+				)
+			except OSError as exc:
+				failure = "ERROR executing \"%s\", %s" % (cmd, exc)
+				break
+			finally:
+				# the parent's copy of the pipe is no longer needed
+				if stdin is not None:
+					stdin.close()
+					stdin = None
+			stdin = process.stdout
+			processes.append((tool, cmd, process))
+	finally:
+		if stdin is not None:
+			stdin.close()
+
+	failed = []
+	for tool, cmd, process in processes:
+		returncode, usage = wait_process(process)
+		if record:
+			record(tool, cmd, start, time.time() - start, usage)
+		if returncode != 0:
+			failed.append(cmd)
+
+	if output is not None:
+		output.seek(0)
+		text = output.read()
+		output.close()
+		if text:
+			log.info(text.rstrip())
+
+	if failure is None and failed:
+		failure = "ERROR %s" % " | ".join(failed)
+	return failure
+
+def run_builtin(name, source, destination, method):
+	if name == "copy":
+		copy_file(source, destination, method)
+	elif name == "move":
+		move_file(source, destination)
+	else:
+		raise OSError("Unknown built-in tool \"%s\"" % name)
+
+def unlink_linked_files(paths):
+	"""
+		Remove the files in paths that have other hard links, such as
+		outputs restored from the output store or linked to their
+		sources, so writing to them doesn't change the other copies.
+	"""
+	for path in paths:
+		try:
+			if os.lstat(path).st_nlink > 1:
+				os.unlink(path)
+		except OSError as exc:
+			if exc.errno != errno.ENOENT:
+				raise
+
+def copy_file(source, destination, method="copy"):
+	"""
+		Copy source to destination without launching a process.
+
+		With a method of "hardlink", the destination is linked to the
+		source when both are on the same filesystem. Otherwise the data
+		is cloned (reflink) where the filesystem supports it, or copied
+		by the kernel with copy_file_range/sendfile when available.
+	"""
+	# never write through an existing destination; it may
+	# be a hardlink to a source file.
+	if os.path.lexists(destination):
+		os.unlink(destination)
+
+	if method == "hardlink" and hasattr(os, "link"):
+		try:
+			os.link(source, destination)
+			return
+		except OSError:
+			pass
+
+	source_fd = os.open(source, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+	try:
+		destination_fd = os.open(
+			destination,
+			os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+		)
+		try:
+			if not clone_file(source_fd, destination_fd):
+				kernel_copy_file(source_fd, destination_fd)
+		finally:
+			os.close(destination_fd)
+	finally:
+		os.close(source_fd)
+
+	shutil.copymode(source, destination)
+
+def clone_file(source_fd, destination_fd):
+	# FICLONE from linux/fs.h; supported by btrfs, xfs and others.
+	if fcntl is None or get_platform() != "linux":
+		return False
+	try:
+		fcntl.ioctl(destination_fd, 0x40049409, source_fd)
+		return True
+	except (IOError, OSError):
+		return False
+
+def kernel_copy_file(source_fd, destination_fd, block_size=1 << 20):
+	"""
+		Copy between two file descriptors, letting the kernel move the
+		data where possible. Both descriptors' offsets advance, so any
+		remainder is copied with plain reads and writes.
+	"""
+	remaining = os.fstat(source_fd).st_size
+	try:
+		while remaining > 0:
+			if hasattr(os, "copy_file_range"):
+				copied = os.copy_file_range(source_fd, destination_fd, remaining)
+			elif hasattr(os, "sendfile") and get_platform() == "linux":
+				copied = os.sendfile(destination_fd, source_fd, None, remaining)
+			else:
+				break
+			if copied == 0:
+				break
+			remaining -= copied
+	except OSError:
+		pass
+
+	while True:
+		block = os.read(source_fd, block_size)
+		if not block:
+			break
+		while block:
+			written = os.write(destination_fd, block)
+			block = block[written:]
+
+def move_file(source, destination):
+	if os.path.lexists(destination):
+		os.unlink(destination)
+	try:
+		os.rename(source, destination)
+	except OSError as exc:
+		if exc.errno != errno.EXDEV:
+			raise
+		copy_file(source, destination)
+		os.unlink(source)
+
 def generate_params_for_file(
 		paths, 
 		asset, 
 		src_file_path,
 		platform_name
 	):
+	params = generate_base_params(paths, asset, platform_name)
+	params.update(generate_file_params(paths, asset, src_file_path))
+	return params
+
+def generate_base_params(paths, asset, platform_name):
 	# base parameters are from the asset block
-	params = copy.copy(asset.params)
+	params = copy.deepcopy(asset.params)
 
 	for key, value in paths:
 		params[key] = value
 
 	# TODO: need to also take variables from root conf
-	basename = os.path.basename(src_file_path)
-
 	params["source_root"] = paths.source_root
 	params["destination_root"] = paths.destination_root
 
+	params["abs_src_folder"] = asset.abs_src_folder
+	params["abs_dst_folder"] = asset.abs_dst_folder
+
+	params["host_platform"] = platform_name
+
+	return params
+
+def generate_file_params(paths, asset, src_file_path):
+	basename = os.path.basename(src_file_path)
+	params = {}
+
 	# default parameters
 	params["src_file_relpath"] = os.path.relpath(src_file_path, paths.source_root)
 	params["src_file_path"] = src_file_path
 	params["src_file_basename"] = basename
-	params["src_file_ext"] = \
-		os.path.basename(src_file_path).split(".")[1]
+	params["src_file_ext"] = basename.split(".")[1]
 
 	params["dst_file_path"] = os.path.join(
-		paths.destination_root,
-		asset.dst_folder,
+		asset.abs_dst_folder,
 		basename
 	)
 	params["dst_file_noext"] = os.path.join(
-		paths.destination_root,
-		asset.dst_folder,
+		asset.abs_dst_folder,
 		basename.split(".")[0]
 	)
 
-	params["abs_src_folder"] = asset.abs_src_folder
-	params["abs_dst_folder"] = asset.abs_dst_folder
+	return params
 
-	params["host_platform"] = platform_name
+def compile_params(paths, asset, platform_name, param_overrides = {}):
+	"""
+		Resolve the parameters that are the same for every file of
+		an asset mask, once per platform and set of overrides.
+
+		Returns (params, deferred), where deferred lists the keys whose
+		values refer to per-file parameters; expand_params resolves those
+		for each file. The result is cached on the asset.
+	"""
+	# keyed by content; callers often pass a new dict each time
+	key = (platform_name, "")
+	if param_overrides:
+		key = (platform_name, json.dumps(param_overrides, sort_keys=True))
+	if key in asset.compiled_params:
+		return asset.compiled_params[key]
+
+	params = generate_base_params(paths, asset, platform_name)
+	params.update(copy.deepcopy(param_overrides))
+
+	# substitute markers for the per-file values to find
+	# out which parameters depend on them.
+	sample = dict(params)
+	for name in FILE_PARAMS:
+		sample[name] = "\0%s\0" % name
+
+	deferred = []
+	for name, value in params.items():
+		if type(value) is dict:
+			deferred.append(name)
+		elif type_is_string(value):
+			try:
+				resolved = value % sample
+			except (KeyError, TypeError, ValueError) as exc:
+				raise Exception(
+					"Unable to resolve param \"%s\" for \"%s/%s\": %s" %
+					(name, asset.src_folder, asset.glob, exc)
+				)
+			if "\0" in resolved:
+				deferred.append(name)
+			else:
+				params[name] = resolved
 
+	compiled = (params, deferred)
+	asset.compiled_params[key] = compiled
+	return compiled
+
+def expand_params(compiled, paths, asset, src_file_path):
+	params, deferred = compiled
+	params = dict(params)
+	params.update(generate_file_params(paths, asset, src_file_path))
+
+	for name in deferred:
+		value = params[name]
+		if type(value) is dict:
+			value = copy.deepcopy(value)
+			recursive_update(value, params)
+			params[name] = value
+		else:
+			params[name] = value % params
 	return params
 
+def validate_tool_templates(
+	tools,
+	current_tool,
+	paths,
+	asset,
+	platform_name,
+	param_overrides = {}
+	):
+	"""
+		Compile the parameters and try every command template of
+		current_tool (and the tools it nests) against a sample file,
+		so substitution errors are reported before the build starts.
+	"""
+	compiled = compile_params(paths, asset, platform_name, param_overrides)
+	sample_path = os.path.join(asset.abs_src_folder, "sample.ext")
+	try:
+		params = expand_params(compiled, paths, asset, sample_path)
+		for name in BATCH_PARAMS:
+			params["%s_list" % name] = params[name]
+		params["step_input"] = sample_path
+		params["step_output"] = sample_path
+
+		current_tool.output % params
+		if current_tool.builtin:
+			return
+
+		raw_commands = current_tool.commands[platform_name]
+		if raw_commands is None:
+			raise Exception(
+				"Tool \"%s\" has no commands for platform \"%s\"" %
+				(current_tool.name, platform_name)
+			)
+
+		for raw_command in raw_commands:
+			if type_is_string(raw_command):
+				raw_command % params
+			elif type(raw_command) is dict:
+				if not raw_command.get("tool", None) in tools:
+					raise Exception(
+						"unknown tool in command block %s" % raw_command
+					)
+				validate_tool_templates(
+					tools,
+					tools[raw_command["tool"]],
+					paths,
+					asset,
+					platform_name,
+					raw_command.get("params", {})
+				)
+	except (KeyError, TypeError, ValueError) as exc:
+		raise Exception(
+			"Tool \"%s\" for \"%s/%s\": bad substitution %s" %
+			(current_tool.name, asset.src_folder, asset.glob, exc)
+		)
+
 
 def get_platform():
 	p = platform.platform().lower()
@@ -144,6 +914,29 @@ def get_platform():
 	else:
 		return "unknown"
 
+def get_physical_memory():
+	"""
+		Return the machine's physical memory in megabytes, or None
+		where it can't be determined.
+	"""
+	try:
+		pages = os.sysconf("SC_PHYS_PAGES")
+		page_size = os.sysconf("SC_PAGE_SIZE")
+	except (AttributeError, ValueError, OSError):
+		return None
+	if pages < 0 or page_size < 0:
+		return None
+	return pages * page_size / (1024 * 1024)
+
+def get_temp_root():
+	"""
+		Returns the folder for temporary files, preferring a RAM-backed
+		file system so intermediate files stay off the disk.
+	"""
+	if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+		return "/dev/shm"
+	return tempfile.gettempdir()
+
 def get_supported_platforms():
 	return [
 		"linux",
@@ -234,23 +1027,129 @@ def strip_trailing_slash(path):
 		path = path[:-1]
 	return path
 
-def type_is_string(value):
-	return type(value) is str or type(value) is unicode
+def hash_file(path, block_size=1 << 20):
+	digest = hashlib.sha1()
+	with open(path, "rb") as file:
+		while True:
+			block = file.read(block_size)
+			if not block:
+				break
+			digest.update(block)
+	return digest.hexdigest()
+
+def list_directory(path):
+	"""
+		Return a sorted list of (name, is_dir, get_stat) for each entry
+		in path. get_stat is a callable returning the entry's stat result,
+		so callers only pay for a stat on the entries they are interested in.
+	"""
+	entries = []
+	if scandir:
+		for entry in scandir(path):
+			entries.append((entry.name, entry.is_dir(), entry.stat))
+	else:
+		for name in os.listdir(path):
+			entry_path = os.path.join(path, name)
+			entries.append((
+				name,
+				os.path.isdir(entry_path),
+				functools.partial(os.stat, entry_path)
+			))
+	entries.sort()
+	return entries
+
+def scan_asset_folders(asset_folders):
+	"""
+		List each distinct source folder once and hand its entries to
+		every asset mask that matches them.
+
+		Returns a dict of asset -> (files, folders), where files is a list
+		of (abs_path, stat, mask) and folders is a list of matching
+		subfolder names. mask is the asset's glob for files matched by
+		several masks, which keep a cache entry per mask (see
+		Cache.mask_path), and None otherwise. Assets whose source folder
+		does not exist are omitted.
+	"""
+	masks_by_folder = {}
+	for asset in asset_folders:
+		masks_by_folder.setdefault(asset.abs_src_folder, []).append(asset)
+
+	results = {}
+	for folder, masks in masks_by_folder.iteritems():
+		try:
+			entries = list_directory(folder)
+		except OSError:
+			continue
+
+		for asset in masks:
+			results[asset] = ([], [])
+
+		for name, is_dir, get_stat in entries:
+			matches = [asset for asset in masks if asset.match(name)]
+			if not matches:
+				continue
 
-def copy_tree(source, destination):
-	import os
-	import shutil
+			if is_dir:
+				for asset in matches:
+					results[asset][1].append(name)
+				continue
 
+			stat = get_stat()
+			path = os.path.join(folder, name)
+			shared = len(matches) > 1
+			for asset in matches:
+				results[asset][0].append(
+					(path, stat, asset.glob if shared else None)
+				)
+	return results
+
+def remove_file(path, root):
+	"""
+		Remove the file at path, along with any folders between it and
+		root left empty.
+	"""
 	try:
-		# if the path already exists, nuke it
-		if os.path.isdir(destination):
-			shutil.rmtree(destination)
-
-		# copy the tree
-		shutil.copytree(source, destination)
-	except OSError as e:
-		import errno
-		if e.errno == errno.EEXIST:
-			pass
-	except:
-		raise	
\ No newline at end of file
+		os.unlink(path)
+	except OSError as exc:
+		if exc.errno != errno.ENOENT:
+			raise
+
+	folder = os.path.dirname(path)
+	root = os.path.abspath(root)
+	while folder.startswith(os.path.join(root, "")):
+		try:
+			os.rmdir(folder)
+		except OSError:
+			break
+		folder = os.path.dirname(folder)
+
+def parse_shard(text):
+	"""
+		Parse a shard given as "i/N", where i counts from 1.
+		Returns (index, count), with index counting from 0.
+	"""
+	try:
+		index, count = [int(part) for part in text.split("/")]
+	except ValueError:
+		raise ValueError("Shard \"%s\" is not in the form i/N" % text)
+
+	if count < 1 or index < 1 or index > count:
+		raise ValueError(
+			"Shard \"%s\" must be between 1/N and N/N" % text
+		)
+	return index - 1, count
+
+def in_shard(relative_path, shard):
+	"""
+		Returns True if relative_path belongs to shard (see parse_shard).
+		Paths are assigned by their hash, so every machine partitions
+		the same tree the same way.
+	"""
+	if shard is None:
+		return True
+	index, count = shard
+	digest = hashlib.md5(relative_path.encode("utf-8")).hexdigest()
+	return int(digest[:8], 16) % count == index
+
+def type_is_string(value):
+	return type(value) is str or type(value) is unicode